@@ -37,6 +37,19 @@ compile it once:
 ("compile" is not exported for ``import *`` usage as it would override the
 built-in ``compile()`` function)
 
+The module-level ``parse()``, ``search()`` and ``findall()`` functions keep
+the most recently used compiled formats in a bounded cache, so calling them
+in a loop with the same format does not compile it again. ``cache_info()``
+reports the cache hits and misses, and ``cache_clear()`` empties the cache.
+
+A compiled Parser can also parse a whole column of strings at once. The
+result holds a list of values per field, and a mask of the strings that
+didn't match:
+
+>>> r = compile("{:d}x{:d}").parse_many(["2x3", "oops", "4x5"])
+>>> r[0], r[1], r.mask
+([2, None, 4], [3, None, 5], [False, True, False])
+
 The default behaviour is to match strings case insensitively. You may match with
 case by specifying `case_sensitive=True`:
 
@@ -421,6 +434,8 @@ __version__ = '1.12.0'
 # yes, I now have two problems
 import re
 import sys
+import threading
+from collections import namedtuple, OrderedDict
 from datetime import datetime, time, tzinfo, timedelta
 from decimal import Decimal
 from functools import partial
@@ -785,6 +800,45 @@ class Parser(object):
         else:
             return Match(self, m)
 
+    def parse_many(self, strings):
+        '''Match my format to each of the strings exactly.
+
+        Return a ColumnResult instance, which holds a list of values per
+        field and a mask of the strings that didn't match. Values are type
+        converted as in parse(), but no Result or Match instance is created
+        per string. Values of the non-matching strings are None.
+        '''
+        match = self._match_re.match
+        group_index = self._match_re.groupindex
+        conversions = self._type_conversions
+        # (values, index in match groups, type conversion) per field
+        columns = []
+        fixed = []
+        for n in self._fixed_fields:
+            fixed.append([])
+            columns.append((fixed[-1], n, conversions.get(n)))
+        named = {}
+        for k in self._named_fields:
+            values = named[self._group_to_name_map[k]] = []
+            columns.append((values, group_index[k] - 1, conversions.get(k)))
+
+        mask = []
+        for string in strings:
+            m = match(string)
+            if m is None:
+                mask.append(True)
+                for values, _, _ in columns:
+                    values.append(None)
+                continue
+            mask.append(False)
+            groups = m.groups()
+            for values, index, convert in columns:
+                if convert is None:
+                    values.append(groups[index])
+                else:
+                    values.append(convert(groups[index], m))
+        return ColumnResult(tuple(fixed), named, mask)
+
     def search(self, string, pos=0, endpos=None, evaluate_result=True):
         '''Search the string for my format.
 
@@ -1154,6 +1208,38 @@ class Result(object):
         return name in self.named
 
 
+class ColumnResult(object):
+    '''The result of a Parser.parse_many().
+
+    Fixed columns may be looked up using `result[index]`.
+
+    Named columns may be looked up using `result['name']`, by the field
+    name as written in the format (dotted and indexed names aren't
+    expanded into nested dicts).
+
+    `result.mask[i]` is True if the i-th string didn't match.
+    '''
+    def __init__(self, fixed, named, mask):
+        self.fixed = fixed
+        self.named = named
+        self.mask = mask
+
+    def __getitem__(self, item):
+        if isinstance(item, int):
+            return self.fixed[item]
+        return self.named[item]
+
+    def __len__(self):
+        return len(self.mask)
+
+    def __repr__(self):
+        return '<%s %d rows, %d fixed, %r named>' % (self.__class__.__name__,
+            len(self.mask), len(self.fixed), sorted(self.named))
+
+    def __contains__(self, name):
+        return name in self.named
+
+
 class Match(object):
     '''The result of a parse() or search() if no results are generated.
 
@@ -1199,6 +1285,57 @@ class ResultIterator(object):
     next = __next__
 
 
+# Compiled parsers used by the module-level functions, least recently used
+# first. Keys are (format, id(extra_types), case_sensitive).
+_CACHE_MAXSIZE = 128
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {'hits': 0, 'misses': 0}
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+def _get_parser(format, extra_types, case_sensitive):
+    '''Return a compiled Parser for the format, reusing a cached one.
+
+    The "extra_types" dict isn't hashable, so it's keyed by identity. The
+    cache entry holds a reference to it, so that its id can't be taken by
+    another object while the entry is alive. Changes made to the dict after
+    the first call aren't picked up.
+    '''
+    key = (format, id(extra_types), bool(case_sensitive))
+    with _cache_lock:
+        entry = _cache.pop(key, None)
+        if entry is not None and entry[0] is extra_types:
+            _cache[key] = entry
+            _cache_stats['hits'] += 1
+            return entry[1]
+        _cache_stats['misses'] += 1
+    parser = Parser(format, extra_types=extra_types,
+                    case_sensitive=case_sensitive)
+    with _cache_lock:
+        _cache[key] = (extra_types, parser)
+        while len(_cache) > _CACHE_MAXSIZE:
+            _cache.popitem(last=False)
+    return parser
+
+
+def cache_info():
+    '''Report statistics of the compiled format cache used by parse(),
+    search() and findall().'''
+    with _cache_lock:
+        return CacheInfo(_cache_stats['hits'], _cache_stats['misses'],
+                         _CACHE_MAXSIZE, len(_cache))
+
+
+def cache_clear():
+    '''Empty the compiled format cache and reset its statistics.'''
+    with _cache_lock:
+        _cache.clear()
+        _cache_stats['hits'] = 0
+        _cache_stats['misses'] = 0
+
+
 def parse(format, string, extra_types=None, evaluate_result=True, case_sensitive=False):
     '''Using "format" attempt to pull values from "string".
 
@@ -1225,7 +1362,7 @@ def parse(format, string, extra_types=None, evaluate_result=True, case_sensitive
 
     In the case there is no match parse() will return None.
     '''
-    p = Parser(format, extra_types=extra_types, case_sensitive=case_sensitive)
+    p = _get_parser(format, extra_types, case_sensitive)
     return p.parse(string, evaluate_result=evaluate_result)
 
 
@@ -1259,7 +1396,7 @@ def search(format, string, pos=0, endpos=None, extra_types=None, evaluate_result
 
     In the case there is no match parse() will return None.
     '''
-    p = Parser(format, extra_types=extra_types, case_sensitive=case_sensitive)
+    p = _get_parser(format, extra_types, case_sensitive)
     return p.search(string, pos, endpos, evaluate_result=evaluate_result)
 
 
@@ -1290,8 +1427,8 @@ def findall(format, string, pos=0, endpos=None, extra_types=None, evaluate_resul
 
     See the module documentation for the use of "extra_types".
     '''
-    p = Parser(format, extra_types=extra_types, case_sensitive=case_sensitive)
-    return Parser(format, extra_types=extra_types).findall(string, pos, endpos, evaluate_result=evaluate_result)
+    p = _get_parser(format, extra_types, case_sensitive)
+    return p.findall(string, pos, endpos, evaluate_result=evaluate_result)
 
 
 def compile(format, extra_types=None, case_sensitive=False):
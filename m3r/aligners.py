@@ -0,0 +1,194 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import numpy
+
+# Alignment algorithms: full DP matrix, DP matrix restricted to a band around
+# the diagonal, and linear-space (Hirschberg) divide and conquer.
+ALIGN_FULL = "full"
+ALIGN_BANDED = "banded"
+ALIGN_LINEAR = "linear"
+ALIGN_MODES = ( ALIGN_FULL, ALIGN_BANDED, ALIGN_LINEAR )
+
+MATCH_SCORE = 2
+MISMATCH_SCORE = -1
+GAP_SCORE = -2
+# Band margin on both sides of the diagonals, residues. PDB sequence is
+# numbered by residue ids, which mostly follow the ref. sequence numbering, so
+# the best alignment stays close to the diagonal.
+BAND_MARGIN = 128
+# Subproblems of linear-space alignment up to this many cells are aligned with
+# the full matrix.
+_LINEAR_BASE_CELLS = 64 * 1024
+_GAP = "-"
+# Score of the cells outside of the band.
+_NO_SCORE = -2 ** 40
+# Traceback moves. Ties are broken in this order, like the original aligner
+# does: gap in PDB sequence, gap in ref. sequence, then match/mismatch.
+_UP = 0
+_LEFT = 1
+_DIAG = 2
+
+
+def Align( ref_fasta, pdb_fasta, mode=ALIGN_FULL ):
+  # Global alignment of ref. sequence and the sequence loaded from PDB, returns
+  # alignment score and the aligned PDB sequence, with gaps inserted.
+  if mode not in ALIGN_MODES:
+    raise RuntimeError( "Unknown alignment mode \"%s\"." % mode )
+  if mode == ALIGN_LINEAR:
+    return _AlignLinear( ref_fasta, pdb_fasta )
+  if mode == ALIGN_BANDED:
+    return _AlignBand( ref_fasta, pdb_fasta, BAND_MARGIN )
+  return _AlignBand( ref_fasta, pdb_fasta, None )
+
+
+def GetAlignmentMemory( mode, ref_length, pdb_length ):
+  # Approximate memory taken by the alignment, bytes. Full and banded
+  # alignments keep a byte per traceback cell, linear-space alignment keeps a
+  # few score rows.
+  row_memory = ( pdb_length + 1 ) * 8 * 6
+  if mode == ALIGN_LINEAR:
+    return row_memory + ( ref_length + pdb_length ) * 2 * 8
+  if mode == ALIGN_BANDED:
+    width = min( pdb_length,
+                 abs( pdb_length - ref_length ) + 2 * BAND_MARGIN ) + 1
+    return row_memory + ( ref_length + 1 ) * width
+  return row_memory + ( ref_length + 1 ) * ( pdb_length + 1 )
+
+
+def _Encode( fasta ):
+  return numpy.frombuffer( str( fasta ), dtype=numpy.uint8 )
+
+
+def _GetBand( row_index, ref_length, pdb_length, margin ):
+  # Columns of the row within the band, which covers both the diagonal from
+  # the start and the diagonal to the end of the matrix.
+  if margin is None:
+    return 0, pdb_length
+  shift = pdb_length - ref_length
+  low = max( 0, min( row_index, row_index + shift ) - margin )
+  high = min( pdb_length, max( row_index, row_index + shift ) + margin )
+  return low, high
+
+
+def _GetColumns( row, row_low, low, high ):
+  # Scores of columns low..high of the row starting at row_low column, the
+  # columns out of the row have no score.
+  result = numpy.full( high - low + 1, _NO_SCORE, dtype=numpy.int64 )
+  start = max( low, row_low )
+  stop = min( high, row_low + len( row ) - 1 )
+  if start <= stop:
+    result[start - low:stop - low + 1] = row[start - row_low:stop - row_low + 1]
+  return result
+
+
+def _NextRow( row, row_low, low, high, ref_code, pdb, moves=None ):
+  # Scores of the next DP row within low..high columns, and its traceback
+  # moves, if requested.
+  up_scores = _GetColumns( row, row_low, low, high ) + GAP_SCORE
+  diag_scores = numpy.full( high - low + 1, _NO_SCORE, dtype=numpy.int64 )
+  diag_low = max( low, 1 )
+  if diag_low <= high:
+    diag_scores[diag_low - low:] = \
+      _GetColumns( row, row_low, diag_low - 1, high - 1 ) + \
+      numpy.where( pdb[diag_low - 1:high] == ref_code, MATCH_SCORE,
+                   MISMATCH_SCORE )
+  scores = numpy.maximum(  # pylint: disable=assignment-from-no-return
+    up_scores, diag_scores )
+  # Gaps in ref. sequence run along the row: the score of a column is the
+  # best of the columns on the left of it, less the gaps between them.
+  gaps = numpy.arange( high - low + 1, dtype=numpy.int64 ) * GAP_SCORE
+  scores = numpy.maximum.accumulate(  # pylint: disable=no-member
+    scores - gaps ) + gaps
+  if moves is not None:
+    is_left = numpy.zeros( len( scores ), dtype=bool )
+    is_left[1:] = scores[1:] == scores[:-1] + GAP_SCORE
+    moves[:] = numpy.where( scores == up_scores, _UP,
+                            numpy.where( is_left, _LEFT, _DIAG ) )
+  return scores
+
+
+def _AlignBand( ref_fasta, pdb_fasta, margin ):
+  ref = _Encode( ref_fasta )
+  pdb = _Encode( pdb_fasta )
+  ref_length = len( ref )
+  pdb_length = len( pdb )
+  low, high = _GetBand( 0, ref_length, pdb_length, margin )
+  row = numpy.arange( low, high + 1, dtype=numpy.int64 ) * GAP_SCORE
+  lows = [ low ]
+  moves = [ numpy.full( high - low + 1, _LEFT, dtype=numpy.int8 ) ]
+  for row_index in range( 1, ref_length + 1 ):
+    row_low = low
+    low, high = _GetBand( row_index, ref_length, pdb_length, margin )
+    row_moves = numpy.empty( high - low + 1, dtype=numpy.int8 )
+    row = _NextRow( row, row_low, low, high, ref[row_index - 1], pdb,
+                    row_moves )
+    lows.append( low )
+    moves.append( row_moves )
+
+  # Trace the moves back from the end.
+  letters = []
+  row_index = ref_length
+  column = pdb_length
+  while row_index > 0 or column > 0:
+    move = moves[row_index][column - lows[row_index]]
+    if row_index > 0 and ( move == _UP or column == 0 ):
+      letters.append( _GAP )
+      row_index = row_index - 1
+    elif move == _LEFT or row_index == 0:
+      letters.append( pdb_fasta[column - 1] )
+      column = column - 1
+    else:
+      letters.append( pdb_fasta[column - 1] )
+      row_index = row_index - 1
+      column = column - 1
+  letters.reverse()
+  return int( row[-1] ), "".join( letters )
+
+
+def _GetLastRow( ref, pdb ):
+  # Last DP row, i.e. scores of aligning all of ref with every prefix of pdb.
+  pdb_length = len( pdb )
+  row = numpy.arange( pdb_length + 1, dtype=numpy.int64 ) * GAP_SCORE
+  for ref_code in ref:
+    row = _NextRow( row, 0, 0, pdb_length, ref_code, pdb )
+  return row
+
+
+def _AlignLinear( ref_fasta, pdb_fasta ):
+  ref_fasta = str( ref_fasta )
+  pdb_fasta = str( pdb_fasta )
+  ref_length = len( ref_fasta )
+  pdb_length = len( pdb_fasta )
+  if ref_length <= 1 or \
+     ( ref_length + 1 ) * ( pdb_length + 1 ) <= _LINEAR_BASE_CELLS:
+    return _AlignBand( ref_fasta, pdb_fasta, None )
+  # Split ref. sequence in halves, and find the column the best alignment
+  # passes the middle row at, by the scores of the upper half and the
+  # reversed lower half. Then align both quarters the same way.
+  middle = ref_length // 2
+  ref = _Encode( ref_fasta )
+  pdb = _Encode( pdb_fasta )
+  upper_scores = _GetLastRow( ref[:middle], pdb )
+  lower_scores = _GetLastRow( ref[middle:][::-1], pdb[::-1] )[::-1]
+  column = int( numpy.argmax( upper_scores + lower_scores ) )
+  upper_score, upper_fasta = _AlignLinear( ref_fasta[:middle],
+                                           pdb_fasta[:column] )
+  lower_score, lower_fasta = _AlignLinear( ref_fasta[middle:],
+                                           pdb_fasta[column:] )
+  return upper_score + lower_score, upper_fasta + lower_fasta
@@ -17,40 +17,44 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 # ------------------------------------------------------------------------------
 import cookielib
-import csv
-import ssl
+import HTMLParser
+import os
 import urllib
-import urllib2
+import urlparse
 
-try:
-  from StringIO import StringIO
-except ImportError:
-  from io import StringIO
+from m3r.mutations import ReadMutationTable
+from m3r.transport import BuildOpener
 
-from contrib.bs4 import BeautifulSoup
-
-_COSMIC_LOGIN_URL = "https://cancer.sanger.ac.uk/cosmic/login"
-_COSMIC_SEARCH_URL = "https://cancer.sanger.ac.uk/cosmic/gene/analysis?ln=%s"
-_COSMIC_MMUT_URL = "https://cancer.sanger.ac.uk/cosmic/gene/positive?all_data" \
-                   "=&id=%i&mut=substitution_missense&src=gene"
+# URL paths are relative to the COSMIC URL, which can be overridden.
+_COSMIC_URL = "https://cancer.sanger.ac.uk/cosmic"
+_COSMIC_LOGIN_PATH = "/login"
+_COSMIC_SEARCH_PATH = "/gene/analysis?ln=%s"
+_COSMIC_MMUT_PATH = "/gene/positive?all_data=&id=%i" \
+                    "&mut=substitution_missense&src=gene"
+_HTML_CHUNK_SIZE = 16 * 1024
 
 
 class COSMICDatabase( object ):
   """This class implements access to COSMIC database. It supports logging in,
   retrieving gene data, mutations lists, etc."""
 
-  def __init__( self ):
+  def __init__( self, session_file=None, url=None ):
+    self._url = ( url or _COSMIC_URL ).rstrip( "/" )
+    self._host = urlparse.urlparse( self._url ).hostname or ""
     self._is_loggedin = False
-    self._context = ssl.SSLContext( ssl.PROTOCOL_TLSv1 )
-    self._cookies = cookielib.CookieJar()
-    self._opener = urllib2.build_opener(
-      urllib2.HTTPRedirectHandler(),
-      urllib2.HTTPHandler( debuglevel=0 ),
-      urllib2.HTTPSHandler( debuglevel=0, context=self._context ),
-      urllib2.HTTPCookieProcessor( self._cookies )
-    )
-    if self._opener is not None:
-      self._opener.addheaders = [ ( "User-agent", "Mozilla/5.0" ) ]
+    self._is_restored = False
+    self._credentials = None
+    self._session_file = session_file
+    if session_file:
+      self._cookies = cookielib.LWPCookieJar( session_file )
+      if os.path.isfile( session_file ):
+        try:
+          self._cookies.load( ignore_discard=True )
+        except ( IOError, cookielib.LoadError ):
+          self._cookies.clear()
+    else:
+      self._cookies = cookielib.CookieJar()
+    self._opener = BuildOpener( self._cookies )
 
   def Login( self, login, password ):
     # Don't login twice.
@@ -61,23 +65,13 @@ class COSMICDatabase( object ):
       if not password:
         raise RuntimeError( self._errmsg_cannot_login + " " +
                             self._errmsg_empty_pass )
-      login_data = urllib.urlencode( {
-        "email" : login,
-        "pass" : password
-      } )
-      response = self._opener.open( _COSMIC_LOGIN_URL, login_data )
-      htmldata = BeautifulSoup( response.read(), features="html.parser" )
-      login_info = htmldata.find( "dd", { "class": "login-error" } )
-      if login_info is not None:
-        vispass = None if not password else "*" * len( password )
-        errormsg = self._errmsg_cannot_login + " " + \
-          ( self._errmsg_credentials % ( login, vispass ) )
-        servermsg = ""
-        for msg in htmldata.find_all( "h3" ):
-          servermsg += msg.string + "."
-        if servermsg is not None:
-          errormsg += " " + ( self._errmsg_servermsg % servermsg )
-        raise RuntimeError( errormsg )
+      # Credentials are kept only until the stored session is confirmed, to
+      # login again, if it has expired.
+      self._credentials = ( login, password )
+      if self._HasStoredSession():
+        self._is_restored = True
+      else:
+        self._PostLogin()
       self._is_loggedin = True
 
   def FindGeneID( self, name ):
@@ -85,17 +79,14 @@ class COSMICDatabase( object ):
       raise RuntimeError( self._errmsg_no_login )
     if name is None:
       raise RuntimeError( self._errmsg_empty_gene )
-    data = self._opener.open( _COSMIC_SEARCH_URL % name )
-    htmldata = BeautifulSoup( data.read(), features="html.parser" )
-    ids = htmldata.find_all( "input", { "name": "id", "type": "hidden" } )
-    lns = htmldata.find_all( "input", { "name": "ln", "type": "hidden" } )
-    id_count = len( ids )
-    if id_count == 0:
+    data = self._Open( self._url + _COSMIC_SEARCH_PATH % name )
+    # Stop parsing as soon as the hidden inputs of the gene are found.
+    scanner = _COSMICPageScanner( name )
+    self._ScanPage( data, scanner )
+    if not scanner.ids:
       raise RuntimeError( self._errmsg_invalid_gene )
-    for i in range( id_count ):
-      if lns[i].get( "value" ) != name:
-        continue
-      return int( ids[i].get( "value" ) )
+    if scanner.gene_id is not None:
+      return int( scanner.gene_id )
     raise RuntimeError( self._errmsg_parse_error )
 
   def GetMissenseMutations( self, gene_id ):
@@ -103,20 +94,86 @@ class COSMICDatabase( object ):
       raise RuntimeError( self._errmsg_no_login )
     if gene_id <= 0:
       raise RuntimeError( self._errmsg_invalid_gene )
-    data = self._opener.open( _COSMIC_MMUT_URL % gene_id )
-    csvdata = data.read()
-    if len( csvdata ) <= 1:
+    data = self._Open( self._url + _COSMIC_MMUT_PATH % gene_id )
+    try:
+      mutations = ReadMutationTable( data )
+    finally:
+      data.close()
+    if mutations is None:
       raise RuntimeError( self._errmsg_parse_error )
-    csvdata_io = StringIO( csvdata )
-    csvreader = csv.reader( csvdata_io, delimiter="\t" )
-    csvheaders = next( csvreader, None )
-    csvparsed = {}
-    for hdr in csvheaders:
-      csvparsed[hdr] = []
-    for row in csvreader:
-      for hdr, var in zip( csvheaders, row ):
-        csvparsed[hdr].append( var )
-    return csvparsed
+    return mutations
+
+  def _PostLogin( self ):
+    login, password = self._credentials
+    login_data = urllib.urlencode( {
+      "email" : login,
+      "pass" : password
+    } )
+    response = self._opener.open( self._url + _COSMIC_LOGIN_PATH,
+                                  login_data )
+    scanner = _COSMICPageScanner()
+    self._ScanPage( response, scanner )
+    if scanner.has_login_error:
+      vispass = None if not password else "*" * len( password )
+      errormsg = self._errmsg_cannot_login + " " + \
+        ( self._errmsg_credentials % ( login, vispass ) )
+      servermsg = "".join( msg + "." for msg in scanner.headers )
+      if servermsg:
+        errormsg += " " + ( self._errmsg_servermsg % servermsg )
+      raise RuntimeError( errormsg )
+    self._credentials = None
+    self._SaveSession()
+
+  def _HasStoredSession( self ):
+    if not self._session_file:
+      return False
+    self._cookies.clear_expired_cookies()
+    return any( _MatchesDomain( self._host, cookie.domain ) for \
+                cookie in self._cookies )
+
+  def _SaveSession( self ):
+    if not self._session_file:
+      return
+    # Create the file readable by the owner only, before cookies are written.
+    file_descriptor = os.open( self._session_file,
+                               os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600 )
+    os.close( file_descriptor )
+    os.chmod( self._session_file, 0600 )
+    self._cookies.save( ignore_discard=True )
+
+  def _ScanPage( self, response, scanner ):
+    try:
+      while not scanner.done:
+        chunk = response.read( _HTML_CHUNK_SIZE )
+        if not chunk:
+          break
+        scanner.feed( chunk )
+    except HTMLParser.HTMLParseError:
+      raise RuntimeError( self._errmsg_parse_error )
+    finally:
+      response.close()
+
+  def _Open( self, url ):
+    cookies = self._GetCookiesState()
+    data = self._opener.open( url )
+    if self._is_restored:
+      # Stored session has expired, if the server redirects to the login page.
+      self._is_restored = False
+      if data.geturl().startswith( self._url + _COSMIC_LOGIN_PATH ):
+        data.close()
+        self._cookies.clear()
+        self._PostLogin()
+        data = self._opener.open( url )
+      else:
+        self._credentials = None
+    # Keep the stored session up to date, if the server has refreshed it.
+    if self._GetCookiesState() != cookies:
+      self._SaveSession()
+    return data
+
+  def _GetCookiesState( self ):
+    return set( ( cookie.domain, cookie.path, cookie.name, cookie.value,
+                  cookie.expires ) for cookie in self._cookies )
 
 
   _errmsg_no_login = "Not logged in."
@@ -128,3 +185,63 @@ class COSMICDatabase( object ):
   _errmsg_empty_pass = "Password is empty."
   _errmsg_credentials = "Email is \"%s\", password is \"%s\"."
   _errmsg_servermsg = "Server responded with the message(s): %s"
+
+
+def _MatchesDomain( host, domain ):
+  # Cookie domain matches the host itself, or the host is its subdomain.
+  domain = domain.lstrip( "." )
+  return host == domain or host.endswith( "." + domain )
+
+
+class _COSMICPageScanner( HTMLParser.HTMLParser ):
+  """This class extracts the few things needed from COSMIC pages: hidden "id"
+  and "ln" inputs of the gene search page, and login error markers of the
+  login page, without building the document tree."""
+
+  def __init__( self, gene_name=None ):
+    HTMLParser.HTMLParser.__init__( self )
+    self.ids = []
+    self.lns = []
+    self.gene_id = None
+    self.has_login_error = False
+    self.headers = []
+    self.done = False
+    self._gene_name = gene_name
+    self._header_data = None
+
+  def handle_starttag( self, tag, attrs ):
+    if tag == "input":
+      attrs = dict( attrs )
+      if attrs.get( "type" ) != "hidden":
+        return
+      if attrs.get( "name" ) == "id":
+        self.ids.append( attrs.get( "value" ) )
+      elif attrs.get( "name" ) == "ln":
+        self.lns.append( attrs.get( "value" ) )
+      else:
+        return
+      self._CheckGene()
+    elif tag == "dd":
+      classes = ( dict( attrs ).get( "class" ) or "" ).split()
+      if "login-error" in classes:
+        self.has_login_error = True
+    elif tag == "h3":
+      self._header_data = []
+
+  def handle_endtag( self, tag ):
+    if tag == "h3" and self._header_data is not None:
+      self.headers.append( "".join( self._header_data ).strip() )
+      self._header_data = None
+
+  def handle_data( self, data ):
+    if self._header_data is not None:
+      self._header_data.append( data )
+
+  def _CheckGene( self ):
+    # Inputs go in pairs, and the pair of the gene is the one needed.
+    if self._gene_name is None:
+      return
+    index = min( len( self.ids ), len( self.lns ) ) - 1
+    if index >= 0 and self.lns[index] == self._gene_name:
+      self.gene_id = self.ids[index]
+      self.done = True
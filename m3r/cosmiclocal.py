@@ -0,0 +1,182 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import csv
+import gzip
+import os
+import sqlite3
+
+import m3r.messages as vm
+from m3r.mutations import MUTATION_COLUMNS
+from m3r.mutations import MutationTable
+from m3r.outputs import ReplaceFile
+
+# Columns of the bulk COSMIC mutant export, in the order of MUTATION_COLUMNS.
+_EXPORT_GENE_COLUMN = "Gene name"
+_EXPORT_DESCRIPTION_COLUMN = "Mutation Description"
+_EXPORT_MISSENSE_DESCRIPTION = "Substitution - Missense"
+_EXPORT_MUTATION_COLUMNS = (
+  "Mutation AA",
+  "Mutation somatic status",
+  "Accession Number",
+  "Mutation zygosity",
+  "Primary site",
+  "Primary histology"
+)
+_STORE_COLUMNS = ( "aa_mutation", "somatic_status", "transcript", "zygosity",
+                   "primary_tissue", "histology" )
+_INSERT_BATCH_SIZE = 10000
+_PROGRESS_INTERVAL = 1000000
+_ERRMSG_EMPTY_EXPORT = "COSMIC export is empty."
+_ERRMSG_MISSING_COLUMN = "COSMIC export has no \"%s\" column."
+
+
+class COSMICLocalDatabase( object ):
+  """This class implements access to a local COSMIC mutation store, built from
+  the bulk mutant export by IngestCOSMICExport. It has the same interface as
+  COSMICDatabase, so the pipeline can run with no network."""
+
+  def __init__( self, store_path ):
+    if not os.path.isfile( store_path ):
+      raise RuntimeError( self._errmsg_no_store % store_path )
+    # The database is queried from a worker thread.
+    self._connection = sqlite3.connect( store_path, check_same_thread=False )
+    self._connection.text_factory = str
+
+  def Login( self, login, password ):
+    # No login is needed for the local store.
+    pass
+
+  def FindGeneID( self, name ):
+    if name is None:
+      raise RuntimeError( self._errmsg_empty_gene )
+    row = self._connection.execute( "SELECT id FROM genes WHERE name = ?",
+                                    ( name, ) ).fetchone()
+    if row is None:
+      raise RuntimeError( self._errmsg_invalid_gene )
+    return row[0]
+
+  def GetMissenseMutations( self, gene_id ):
+    if gene_id <= 0:
+      raise RuntimeError( self._errmsg_invalid_gene )
+    cursor = self._connection.execute(
+      "SELECT %s FROM mutations WHERE gene_id = ? ORDER BY rowid" % \
+      ", ".join( _STORE_COLUMNS ), ( gene_id, ) )
+    mutations = MutationTable( MUTATION_COLUMNS )
+    for row in cursor:
+      mutations.Append( row )
+    return mutations
+
+
+  _errmsg_no_store = "COSMIC mutation store \"%s\" doesn't exist."
+  _errmsg_empty_gene = "Gene name is not specified."
+  _errmsg_invalid_gene = "Gene name/id is not valid."
+
+
+def IngestCOSMICExport( export_path, store_path ):
+  # The store is built aside, and replaces the existing one only once it's
+  # complete, so that a failed ingest leaves the old store intact.
+  temp_path = store_path + ".tmp"
+  if os.path.exists( temp_path ):
+    os.remove( temp_path )
+  if export_path.endswith( ".gz" ):
+    export_file = gzip.open( export_path, "rb" )
+  else:
+    export_file = open( export_path, "rb" )
+  is_built = False
+  try:
+    connection = sqlite3.connect( temp_path )
+    connection.text_factory = str
+    try:
+      with export_file:
+        row_count = _LoadExport( connection, export_file )
+      _BuildStore( connection )
+      connection.commit()
+    finally:
+      connection.close()
+    ReplaceFile( temp_path, store_path )
+    is_built = True
+  finally:
+    if not is_built and os.path.exists( temp_path ):
+      os.remove( temp_path )
+  return row_count
+
+
+def _LoadExport( connection, export_file ):
+  connection.execute( "PRAGMA journal_mode = OFF" )
+  connection.execute( "PRAGMA synchronous = OFF" )
+  connection.execute( "CREATE TABLE genes ( id INTEGER PRIMARY KEY, "
+                      "name TEXT UNIQUE NOT NULL )" )
+  connection.execute( "CREATE TABLE staging ( gene_id INTEGER NOT NULL, %s )" % \
+                      ", ".join( "%s TEXT" % name for name in _STORE_COLUMNS ) )
+  csvreader = csv.reader( export_file, delimiter="\t" )
+  csvheaders = next( csvreader, None )
+  if not csvheaders:
+    raise RuntimeError( _ERRMSG_EMPTY_EXPORT )
+  required_columns = ( _EXPORT_GENE_COLUMN, _EXPORT_DESCRIPTION_COLUMN ) + \
+                     _EXPORT_MUTATION_COLUMNS
+  for name in required_columns:
+    if name not in csvheaders:
+      raise RuntimeError( _ERRMSG_MISSING_COLUMN % name )
+  gene_index = csvheaders.index( _EXPORT_GENE_COLUMN )
+  description_index = csvheaders.index( _EXPORT_DESCRIPTION_COLUMN )
+  mutation_indices = [ csvheaders.index( name ) for name in \
+                       _EXPORT_MUTATION_COLUMNS ]
+  last_index = max( [ gene_index, description_index ] + mutation_indices )
+
+  insert_query = "INSERT INTO staging VALUES ( ?, %s )" % \
+                 ", ".join( "?" * len( _STORE_COLUMNS ) )
+  gene_ids = {}
+  batch = []
+  row_count = 0
+  for row_index, row in enumerate( csvreader ):
+    if row_index and row_index % _PROGRESS_INTERVAL == 0:
+      vm.Info( "%i export rows processed, %i missense mutations found..." % \
+               ( row_index, row_count ) )
+    if len( row ) <= last_index:
+      continue
+    if row[description_index] != _EXPORT_MISSENSE_DESCRIPTION:
+      continue
+    gene_name = row[gene_index]
+    gene_id = gene_ids.get( gene_name )
+    if gene_id is None:
+      gene_id = len( gene_ids ) + 1
+      gene_ids[gene_name] = gene_id
+      connection.execute( "INSERT INTO genes VALUES ( ?, ? )",
+                          ( gene_id, gene_name ) )
+    batch.append( [ gene_id ] + [ row[i] for i in mutation_indices ] )
+    row_count = row_count + 1
+    if len( batch ) >= _INSERT_BATCH_SIZE:
+      connection.executemany( insert_query, batch )
+      batch = []
+  if batch:
+    connection.executemany( insert_query, batch )
+  connection.commit()
+  return row_count
+
+
+def _BuildStore( connection ):
+  # Copy the rows ordered by gene, so that the mutations of one gene are
+  # stored next to each other, then index them.
+  vm.Info( "Building the gene index..." )
+  connection.execute( "CREATE TABLE mutations AS SELECT * FROM staging "
+                      "ORDER BY gene_id, rowid" )
+  connection.execute( "DROP TABLE staging" )
+  connection.execute( "CREATE INDEX mutations_gene ON mutations ( gene_id )" )
+  connection.commit()
+  connection.execute( "VACUUM" )
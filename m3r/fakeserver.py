@@ -0,0 +1,294 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import BaseHTTPServer
+import gzip
+import json
+import os
+import random
+import re
+import SocketServer
+import StringIO
+import threading
+import time
+import urlparse
+import uuid
+
+_COSMIC_PATH = "/cosmic"
+_EUTILS_PATH = "/eutils"
+_SESSION_COOKIE = "m3r_session"
+_FIXTURE_SUFFIX = ".json"
+_WRITE_CHUNK_SIZE = 16 * 1024
+_SYMBOL_RE = re.compile( r"([^\s()]+)\[sym\]" )
+_LOGIN_PAGE = "<html><body><h1>COSMIC</h1>%s</body></html>"
+_LOGIN_ERROR = "<dl><dd class=\"login-error\">Login failed</dd></dl>" \
+               "<h3>Invalid email or password</h3>"
+_SEARCH_INPUTS = "<form action=\"/cosmic/gene/analysis\">" \
+                 "<input type=\"hidden\" name=\"ln\" value=\"%s\"/>" \
+                 "<input type=\"hidden\" name=\"id\" value=\"%i\"/></form>"
+
+
+class FakeServerOptions( object ):
+  """This class holds the behaviour knobs of the fake server: latency added to
+  every request, bandwidth limit of the response body, and the rate of
+  injected errors."""
+
+  def __init__( self, latency=0.0, bandwidth=0, error_rate=0.0,
+                error_code=503, seed=None, email=None, password=None ):
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.error_rate = error_rate
+    self.error_code = error_code
+    self.email = email
+    self.password = password
+    self.random = random.Random( seed )
+    self.lock = threading.Lock()
+
+
+class FakeServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+  """This class implements a local stand-in for COSMIC and NCBI E-utilities.
+  It replays login, gene search, missense mutations export, esearch,
+  esummary, elink and efetch endpoints from the fixtures directory."""
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__( self, address, fixtures_dir, options=None ):
+    BaseHTTPServer.HTTPServer.__init__( self, address, _FakeRequestHandler )
+    self.options = options or FakeServerOptions()
+    self.genes = LoadFixtures( fixtures_dir )
+    self.sessions = set()
+    self._thread = None
+
+  def GetCOSMICURL( self ):
+    return "http://%s:%i%s" % ( self.server_address[0],
+                                self.server_address[1], _COSMIC_PATH )
+
+  def GetNCBIURL( self ):
+    return "http://%s:%i%s/" % ( self.server_address[0],
+                                 self.server_address[1], _EUTILS_PATH )
+
+  def StartThread( self ):
+    self._thread = threading.Thread( target=self.serve_forever )
+    self._thread.daemon = True
+    self._thread.start()
+
+  def Stop( self ):
+    self.shutdown()
+    self.server_close()
+    if self._thread is not None:
+      self._thread.join()
+
+
+class _FakeRequestHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+  """This class handles a single request to the fake server."""
+
+  protocol_version = "HTTP/1.1"
+
+  def do_GET( self ):  # pylint: disable=invalid-name
+    self._Handle( urlparse.urlparse( self.path ).query )
+
+  def do_POST( self ):  # pylint: disable=invalid-name
+    content_length = int( self.headers.getheader( "Content-Length" ) or 0 )
+    self._Handle( self.rfile.read( content_length ) )
+
+  def log_message( self, *args ):  # pylint: disable=invalid-name,arguments-differ
+    pass
+
+  def _Handle( self, query ):
+    options = self.server.options
+    if options.latency:
+      time.sleep( options.latency )
+    with options.lock:
+      is_error = options.random.random() < options.error_rate
+    if is_error:
+      self._Respond( options.error_code, "text/plain", "Injected error\n" )
+      return
+    path = urlparse.urlparse( self.path ).path
+    params = urlparse.parse_qs( query, keep_blank_values=True )
+    handlers = {
+      _COSMIC_PATH + "/login": self._COSMICLogin,
+      _COSMIC_PATH + "/gene/analysis": self._COSMICSearch,
+      _COSMIC_PATH + "/gene/positive": self._COSMICMutations,
+      _EUTILS_PATH + "/esearch.fcgi": self._ESearch,
+      _EUTILS_PATH + "/esummary.fcgi": self._ESummary,
+      _EUTILS_PATH + "/elink.fcgi": self._ELink,
+      _EUTILS_PATH + "/efetch.fcgi": self._EFetch
+    }
+    handler = handlers.get( path )
+    if handler is None:
+      self._Respond( 404, "text/plain", "Not found\n" )
+      return
+    handler( params )
+
+  def _COSMICLogin( self, params ):
+    if self.command != "POST":
+      self._Respond( 200, "text/html", _LOGIN_PAGE % "" )
+      return
+    options = self.server.options
+    email = params.get( "email", [ "" ] )[0]
+    password = params.get( "pass", [ "" ] )[0]
+    if ( options.email and email != options.email ) or \
+       ( options.password and password != options.password ):
+      self._Respond( 200, "text/html", _LOGIN_PAGE % _LOGIN_ERROR )
+      return
+    session = uuid.uuid4().hex
+    self.server.sessions.add( session )
+    self._Respond( 200, "text/html", _LOGIN_PAGE % "",
+                   [ ( "Set-Cookie", "%s=%s; Path=/" % ( _SESSION_COOKIE,
+                                                         session ) ) ] )
+
+  def _COSMICSearch( self, params ):
+    if not self._HasSession():
+      return
+    name = params.get( "ln", [ "" ] )[0].upper()
+    inputs = "".join( _SEARCH_INPUTS % ( gene["symbol"], gene["cosmic_id"] )
+                      for symbol, gene in sorted( self.server.genes.items() )
+                      if symbol.startswith( name ) )
+    self._Respond( 200, "text/html", _LOGIN_PAGE % inputs )
+
+  def _COSMICMutations( self, params ):
+    if not self._HasSession():
+      return
+    gene_id = int( params.get( "id", [ "0" ] )[0] )
+    for gene in self.server.genes.itervalues():
+      if gene["cosmic_id"] == gene_id:
+        self._Respond( 200, "text/tab-separated-values",
+                       gene["mutations_data"] )
+        return
+    self._Respond( 200, "text/tab-separated-values", "" )
+
+  def _ESearch( self, params ):
+    term = params.get( "term", [ "" ] )[0]
+    symbols = _SYMBOL_RE.findall( term )
+    if not symbols:
+      symbols = [ term ]
+    id_list = [ str( self.server.genes[symbol.upper()]["ncbi_id"] )
+                for symbol in symbols if symbol.upper() in self.server.genes ]
+    self._RespondJSON( { "esearchresult": {
+      "count": str( len( id_list ) ),
+      "idlist": id_list
+    } } )
+
+  def _ESummary( self, params ):
+    ids = _SplitIDs( params.get( "id", [] ) )
+    summary = { "uids": [] }
+    for gene in self.server.genes.itervalues():
+      uid = str( gene["ncbi_id"] )
+      if uid in ids:
+        summary["uids"].append( uid )
+        summary[uid] = { "uid": uid, "name": gene["symbol"] }
+    self._RespondJSON( { "result": summary } )
+
+  def _ELink( self, params ):
+    id_key = "accession" if params.get( "idtype" ) == [ "acc" ] else "gi"
+    linksets = []
+    for uid in _SplitIDs( params.get( "id", [] ) ):
+      for gene in self.server.genes.itervalues():
+        if str( gene["ncbi_id"] ) != uid:
+          continue
+        linksets.append( {
+          "dbfrom": "gene",
+          "ids": [ uid ],
+          "linksetdbs": [ {
+            "dbto": "protein",
+            "linkname": "gene_protein_refseq",
+            "links": [ str( protein[id_key] )
+                       for protein in gene["proteins"] ]
+          } ]
+        } )
+    self._RespondJSON( { "linksets": linksets } )
+
+  def _EFetch( self, params ):
+    proteins = {}
+    for gene in self.server.genes.itervalues():
+      for protein in gene["proteins"]:
+        proteins[str( protein["gi"] )] = protein
+        proteins[protein["accession"]] = protein
+    records = []
+    for uid in _SplitIDs( params.get( "id", [] ) ):
+      protein = proteins.get( uid )
+      if protein is None:
+        continue
+      sequence = protein["sequence"]
+      lines = [ sequence[i:i + 70] for i in range( 0, len( sequence ), 70 ) ]
+      records.append( ">%s %s\n%s\n" % ( protein["accession"],
+                                         protein["description"],
+                                         "\n".join( lines ) ) )
+    self._Respond( 200, "text/plain", "\n".join( records ) )
+
+  def _HasSession( self ):
+    cookies = self.headers.getheader( "Cookie" ) or ""
+    for cookie in cookies.split( ";" ):
+      name, _, value = cookie.strip().partition( "=" )
+      if name == _SESSION_COOKIE and value in self.server.sessions:
+        return True
+    self._Respond( 302, "text/html", "",
+                   [ ( "Location", _COSMIC_PATH + "/login" ) ] )
+    return False
+
+  def _RespondJSON( self, data ):
+    self._Respond( 200, "application/json", json.dumps( data ) )
+
+  def _Respond( self, code, content_type, body, headers=None ):
+    if isinstance( body, unicode ):
+      body = body.encode( "utf-8" )
+    accept_encoding = self.headers.getheader( "Accept-Encoding" ) or ""
+    is_gzipped = "gzip" in accept_encoding and len( body ) > 0
+    if is_gzipped:
+      buf = StringIO.StringIO()
+      with gzip.GzipFile( fileobj=buf, mode="wb" ) as gzip_file:
+        gzip_file.write( body )
+      body = buf.getvalue()
+    self.send_response( code )
+    self.send_header( "Content-Type", content_type )
+    self.send_header( "Content-Length", str( len( body ) ) )
+    if is_gzipped:
+      self.send_header( "Content-Encoding", "gzip" )
+    for name, value in headers or []:
+      self.send_header( name, value )
+    self.end_headers()
+    bandwidth = self.server.options.bandwidth
+    for start in range( 0, len( body ), _WRITE_CHUNK_SIZE ):
+      chunk = body[start:start + _WRITE_CHUNK_SIZE]
+      self.wfile.write( chunk )
+      if bandwidth:
+        time.sleep( float( len( chunk ) ) / bandwidth )
+
+
+def _SplitIDs( values ):
+  ids = []
+  for value in values:
+    ids.extend( uid.strip() for uid in value.split( "," ) if uid.strip() )
+  return ids
+
+
+def LoadFixtures( fixtures_dir ):
+  # Every gene is described by "<SYMBOL>.json" file, with the mutations
+  # export (as served by COSMIC) in the file it references.
+  genes = {}
+  for filename in sorted( os.listdir( fixtures_dir ) ):
+    if not filename.endswith( _FIXTURE_SUFFIX ):
+      continue
+    with open( os.path.join( fixtures_dir, filename ), "r" ) as file_object:
+      gene = json.load( file_object )
+    with open( os.path.join( fixtures_dir, gene["mutations"] ), "rb" ) as \
+         file_object:
+      gene["mutations_data"] = file_object.read()
+    genes[gene["symbol"].upper()] = gene
+  return genes
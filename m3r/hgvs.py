@@ -0,0 +1,88 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import re
+
+import numpy
+
+# Kinds of protein changes.
+MISSENSE = 0
+NONSENSE = 1
+SYNONYMOUS = 2
+UNKNOWN = 3
+
+# Simple substitution: reference AA, position and alternative AA, stop codon
+# or "=" for synonymous change.
+_SUBSTITUTION = re.compile( r"^p\.([A-Z])(\d+)([A-Z*=])$" )
+_ALT_KINDS = { "*": NONSENSE, "=": SYNONYMOUS }
+
+
+class ProteinChanges( object ):
+  """This class keeps decoded HGVS protein changes as parallel arrays of
+  reference AA, position, alternative AA and the kind of change. Changes that
+  are not simple substitutions (p.?, p.*123Q, frameshifts, indels, etc.) are of
+  UNKNOWN kind, with zero position and empty AAs."""
+
+  def __init__( self, ref, pos, alt, kind ):
+    self.ref = ref
+    self.pos = pos
+    self.alt = alt
+    self.kind = kind
+
+  def Take( self, indices ):
+    return ProteinChanges( self.ref[indices], self.pos[indices],
+                           self.alt[indices], self.kind[indices] )
+
+  def __len__( self ):
+    return len( self.kind )
+
+
+def ParseProteinChange( text ):
+  match = _SUBSTITUTION.match( text.strip() )
+  if match is None:
+    return "", 0, "", UNKNOWN
+  ref, pos, alt = match.groups()
+  pos = int( pos )
+  if pos <= 0:
+    return "", 0, "", UNKNOWN
+  # Older exports spell synonymous changes as p.R123R.
+  if alt == ref:
+    return ref, pos, "=", SYNONYMOUS
+  return ref, pos, alt, _ALT_KINDS.get( alt, MISSENSE )
+
+
+def ParseProteinChanges( values ):
+  refs, positions, alts, kinds = [], [], [], []
+  for value in values:
+    ref, pos, alt, kind = ParseProteinChange( value )
+    refs.append( ref )
+    positions.append( pos )
+    alts.append( alt )
+    kinds.append( kind )
+  return ProteinChanges( numpy.array( refs, dtype="S1" ),
+                         numpy.array( positions, dtype=numpy.int32 ),
+                         numpy.array( alts, dtype="S1" ),
+                         numpy.array( kinds, dtype=numpy.int8 ) )
+
+
+def ParseMutationColumn( column ):
+  # Column is dictionary-encoded, so only its distinct values are parsed, and
+  # the rows take the decoded values by category codes.
+  changes = ParseProteinChanges( column.categories )
+  codes = numpy.array( column.codes, dtype=numpy.intp )
+  return changes.Take( codes )
@@ -0,0 +1,241 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import collections
+import json
+
+import numpy
+
+import m3r.hgvs as hgvs
+
+_GAP = ord( "-" )
+# Metadata columns of mutation info, by COSMIC column.
+_INFO_COLUMNS = (
+  ( "status", "Somatic Status" ),
+  ( "transcript", "Transcript" ),
+  ( "zygosity", "Zygosity" ),
+  ( "tissue", "Primary Tissue" ),
+  ( "histology", "Histology" )
+)
+# Columns of the mutation mapping table, written in plan mode.
+PLAN_COLUMNS = (
+  "gene",
+  "pdb",
+  "chain",
+  "mutation",
+  "position",
+  "resid",
+  "isoform",
+  "tissue",
+  "histology",
+  "zygosity",
+  "status",
+  "transcript",
+  "recurrence",
+  "sampled"
+)
+
+
+class MappedMutations( object ):
+  """This class implements a compact table of mutations projected onto PDB
+  structure. For every distinct (position, alternative AA) pair it keeps the
+  COSMIC row of its first occurrence, reference and alternative AAs, and PDB
+  residue number, sorted by position and alternative AA."""
+
+  def __init__( self, rows, positions, refs, alts, resids ):
+    self.rows = rows
+    self.positions = positions
+    self.refs = refs
+    self.alts = alts
+    self.resids = resids
+
+  def Take( self, indices ):
+    return MappedMutations( self.rows[indices], self.positions[indices],
+                            self.refs[indices], self.alts[indices],
+                            self.resids[indices] )
+
+  def GetName( self, index ):
+    return "%s%i%s" % ( self.refs[index], self.positions[index],
+                        self.alts[index] )
+
+  def GetMutationInfo( self, index, mutations ):
+    # Mutation info as expected by PDBFile.MutateAA(), metadata is taken from
+    # the COSMIC row the mutation comes from.
+    row = int( self.rows[index] )
+    info = {
+      "name" : self.GetName( index ),
+      "resid" : int( self.resids[index] ),
+      "from" : str( self.refs[index] ),
+      "to" : str( self.alts[index] )
+    }
+    for key, column in _INFO_COLUMNS:
+      info[key] = mutations[column][row]
+    return info
+
+  def __len__( self ):
+    return len( self.rows )
+
+
+class PlanWriter( object ):
+  """This class writes mutation mapping table rows to a stream, either as TSV
+  with a header line, or as JSON Lines."""
+
+  def __init__( self, stream, json_lines=False ):
+    self._stream = stream
+    self._json_lines = json_lines
+    if not json_lines:
+      stream.write( "\t".join( PLAN_COLUMNS ) + "\n" )
+
+  def Write( self, rows ):
+    for row in rows:
+      if self._json_lines:
+        line = json.dumps( collections.OrderedDict( zip( PLAN_COLUMNS, row ) ) )
+      else:
+        line = "\t".join( _PlanValue( value ) for value in row )
+      self._stream.write( line + "\n" )
+    self._stream.flush()
+
+
+def _PlanValue( value ):
+  if isinstance( value, unicode ):
+    return value.encode( "utf-8" )
+  return str( value )
+
+
+def GetReferenceSites( changes ):
+  # Distinct (position, reference AA) pairs of the decoded changes, reference
+  # AAs are returned as byte codes.
+  known = changes.kind != hgvs.UNKNOWN
+  keys = changes.pos[known].astype( numpy.int64 ) * 256 + \
+         changes.ref[known].view( numpy.uint8 )
+  keys = numpy.unique( keys )
+  return keys // 256, ( keys % 256 ).astype( numpy.uint8 )
+
+
+def MatchIsoforms( changes, fastas ):
+  # Score every isoform with the fraction of distinct reference sites of the
+  # changes it agrees with. Sites past the end of isoform don't match. All the
+  # isoforms are concatenated and compared in one gather, returns (name,
+  # fraction) pairs in the order of fastas.
+  names = list( fastas )
+  positions, refs = GetReferenceSites( changes )
+  if positions.size == 0:
+    return [ ( name, 1.0 ) for name in names ]
+  sequences = [ numpy.frombuffer( str( fastas[name] ), dtype=numpy.uint8 )
+                for name in names ]
+  lengths = numpy.array( [ len( sequence ) for sequence in sequences ],
+                         dtype=numpy.int64 )
+  offsets = numpy.cumsum( lengths ) - lengths
+  # Trailing zero is gathered in place of the sites out of range.
+  residues = numpy.concatenate( sequences + [ numpy.zeros( 1, numpy.uint8 ) ] )
+  indices = positions[numpy.newaxis, :] - 1
+  in_range = indices < lengths[:, numpy.newaxis]
+  gathered = residues[numpy.where( in_range,
+                                   indices + offsets[:, numpy.newaxis],
+                                   len( residues ) - 1 )]
+  matches = in_range & ( gathered == refs[numpy.newaxis, :] )
+  fractions = matches.sum( axis=1 ) / float( len( positions ) )
+  return zip( names, fractions.tolist() )
+
+
+def SelectIsoform( isoform_matches ):
+  # The first isoform that agrees with all the reference sites.
+  for name, fraction in isoform_matches:
+    if fraction >= 1.0:
+      return name
+  return None
+
+
+def BuildResidueMap( aligned_fasta, pdb_fasta ):
+  # PDB residue number for every position of the aligned sequence, zero for
+  # gaps. Aligned sequence is PDB sequence with gaps inserted, so its k-th
+  # residue is the k-th residue present in PDB sequence.
+  aligned = numpy.frombuffer( str( aligned_fasta ), dtype=numpy.uint8 )
+  pdb = numpy.frombuffer( str( pdb_fasta ), dtype=numpy.uint8 )
+  present_resids = numpy.flatnonzero( pdb != _GAP ) + 1
+  is_residue = aligned != _GAP
+  ranks = numpy.cumsum( is_residue ) - 1
+  is_residue &= ranks < len( present_resids )
+  resid_map = numpy.zeros( len( aligned ), dtype=numpy.int32 )
+  resid_map[is_residue] = present_resids[ranks[is_residue]]
+  return resid_map
+
+
+def ProjectMutations( changes, aligned_fasta, resid_map ):
+  # Missense changes which reference AA agrees with the aligned sequence,
+  # one per (position, alternative AA). Mutations of the residues missing in
+  # PDB have zero residue number.
+  aligned = numpy.frombuffer( str( aligned_fasta ), dtype=numpy.uint8 )
+  positions = changes.pos.astype( numpy.int64 )
+  rows = numpy.flatnonzero( ( changes.kind == hgvs.MISSENSE ) & \
+                            ( positions >= 1 ) & \
+                            ( positions <= len( aligned ) ) )
+  rows = rows[aligned[positions[rows] - 1] == \
+              changes.ref[rows].view( numpy.uint8 )]
+  # Stable sort of unique() keeps the first COSMIC row of every key, and the
+  # keys come out sorted by position, then alternative AA.
+  keys = positions[rows] * 256 + changes.alt[rows].view( numpy.uint8 )
+  _, first_indices = numpy.unique( keys, return_index=True )
+  rows = rows[first_indices]
+  return MappedMutations( rows, changes.pos[rows], changes.ref[rows],
+                          changes.alt[rows], resid_map[positions[rows] - 1] )
+
+
+def BuildPlanRows( genename, pdbname, chainid, isoform, pdb_mutations,
+                   mutations, recurrences, sampled_indices ):
+  # Mapping table rows in the order of PLAN_COLUMNS, isoform is given by the
+  # accession of its ref. sequence.
+  sampled_indices = set( sampled_indices )
+  isoform_id = isoform.split()[0] if isoform else ""
+  rows = []
+  for index in range( len( pdb_mutations ) ):
+    info = pdb_mutations.GetMutationInfo( index, mutations )
+    rows.append( ( genename, pdbname, chainid, info["name"],
+                   int( pdb_mutations.positions[index] ), info["resid"],
+                   isoform_id, info["tissue"], info["histology"],
+                   info["zygosity"], info["status"], info["transcript"],
+                   int( recurrences[index] ), int( index in sampled_indices ) ) )
+  return rows
+
+
+def GetTissueMask( tissue_column, tissue ):
+  # COSMIC rows of the tissue, tissue names are compared case-insensitively.
+  tissue = tissue.lower()
+  tissue_codes = [ code for code, name in enumerate( tissue_column.categories )
+                   if name.lower() == tissue ]
+  return numpy.in1d( numpy.array( tissue_column.codes, dtype=numpy.intp ),
+                     tissue_codes )
+
+
+def CountMutationRows( changes, pdb_mutations, row_mask=None ):
+  # Number of COSMIC rows of every mapped mutation, only the rows in the mask
+  # are counted, if it's given.
+  rows = changes.kind == hgvs.MISSENSE
+  if row_mask is not None:
+    rows &= row_mask
+  row_keys = numpy.sort( _MutationKeys( changes.pos[rows], changes.ref[rows],
+                                        changes.alt[rows] ) )
+  keys = _MutationKeys( pdb_mutations.positions, pdb_mutations.refs,
+                        pdb_mutations.alts )
+  return numpy.searchsorted( row_keys, keys, "right" ) - \
+         numpy.searchsorted( row_keys, keys, "left" )
+
+
+def _MutationKeys( positions, refs, alts ):
+  return ( positions.astype( numpy.int64 ) * 256 + refs.view( numpy.uint8 ) ) * \
+         256 + alts.view( numpy.uint8 )
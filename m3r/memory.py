@@ -0,0 +1,137 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import collections
+import gc
+import sys
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+# How allocations are accounted: traced by tracemalloc, or approximated by the
+# shallow sizes of the container objects gc tracks, which leave out most of
+# strings and numpy array buffers.
+ACCOUNTING_METHOD = "tracemalloc" if tracemalloc is not None else "gc"
+# Number of top allocation sites kept per stage.
+TOP_SITES_COUNT = 10
+# ru_maxrss is in kilobytes on Linux, and in bytes on macOS.
+_MAXRSS_SCALE = 1 if sys.platform == "darwin" else 1024
+
+
+class StageMemory( object ):
+  """This class keeps memory counters of a single stage: net size of the memory
+  allocated by the stage (bytes), growth of the process peak RSS during it,
+  peak RSS of the process after it, and the sites that have allocated most.
+  Sites are source lines with tracemalloc, or object types otherwise, when the
+  allocated size is only approximate (see ACCOUNTING_METHOD)."""
+
+  def __init__( self ):
+    self.accounting = ACCOUNTING_METHOD
+    self.allocated = 0
+    self.rss_growth = 0
+    self.peak_rss = 0
+    self.sites = collections.Counter()
+
+  def Add( self, values ):
+    self.accounting = values["accounting"]
+    self.allocated = self.allocated + values["allocated"]
+    self.rss_growth = self.rss_growth + values["rss_growth"]
+    self.peak_rss = max( self.peak_rss, values["peak_rss"] )
+    for site, size in values["top_sites"]:
+      self.sites[site] += size
+
+  def GetTopSites( self ):
+    return [ [ site, size ] for site, size in \
+             self.sites.most_common( TOP_SITES_COUNT ) if size > 0 ]
+
+  def ToDict( self ):
+    return collections.OrderedDict( [
+      ( "accounting", self.accounting ),
+      ( "allocated", self.allocated ),
+      ( "rss_growth", self.rss_growth ),
+      ( "peak_rss", self.peak_rss ),
+      ( "top_sites", self.GetTopSites() )
+    ] )
+
+
+class MemoryTracker( object ):
+  """This class implements memory accounting of the pipeline stages, by the
+  snapshots taken at the stage boundaries. Allocations are traced with
+  tracemalloc, where it's available. Otherwise the live objects are summed up
+  by type with the gc module, which only sees container objects, so the sizes
+  are approximate. Growth of the peak RSS is measured either way, and it does
+  include data buffers. Stages that run concurrently on different threads see
+  each other's allocations."""
+
+  def __init__( self ):
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  @staticmethod
+  def TakeSnapshot():
+    if tracemalloc is not None:
+      return GetPeakRSS(), tracemalloc.take_snapshot()
+    return GetPeakRSS(), _GetObjectSizes()
+
+  @staticmethod
+  def CompareSnapshots( start_snapshot ):
+    # Returns the memory counters of the stage that has begun with the
+    # snapshot, in the form StageMemory.Add() takes.
+    start_peak_rss, snapshot = start_snapshot
+    if tracemalloc is not None:
+      sites = [ ( "%s:%i" % ( stat.traceback[0].filename,
+                              stat.traceback[0].lineno ), stat.size_diff )
+                for stat in tracemalloc.take_snapshot().compare_to(
+                  snapshot, "lineno" ) ]
+    else:
+      object_sizes = _GetObjectSizes( snapshot )
+      object_sizes.subtract( snapshot )
+      sites = object_sizes.items()
+    sites.sort( key=lambda site: site[1], reverse=True )
+    peak_rss = GetPeakRSS()
+    return {
+      "accounting" : ACCOUNTING_METHOD,
+      "allocated" : sum( size for _, size in sites ),
+      "rss_growth" : max( 0, peak_rss - start_peak_rss ),
+      "peak_rss" : peak_rss,
+      "top_sites" : sites[:TOP_SITES_COUNT]
+    }
+
+
+def GetPeakRSS():
+  # Peak resident set size of the process, bytes, or 0 if it's unknown.
+  if resource is None:
+    return 0
+  return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * _MAXRSS_SCALE
+
+
+def _GetObjectSizes( snapshot=None ):
+  # Sizes of live objects by type, the snapshots themselves are left out.
+  object_sizes = collections.Counter()
+  ignored_ids = ( id( object_sizes ), id( snapshot ) )
+  for obj in gc.get_objects():
+    if id( obj ) not in ignored_ids:
+      object_sizes[type( obj ).__name__] += sys.getsizeof( obj, 0 )
+  return object_sizes
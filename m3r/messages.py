@@ -19,34 +19,42 @@
 from __future__ import print_function
 
 import sys
+import threading
 
 import contrib.colorama as colorama
 
 HR_LINE = "-" * 64
 NO_BANNER = False
+# Messages are printed from several threads, keep the lines whole.
+_PRINT_LOCK = threading.Lock()
+
+
+def _PrintLine( message, **kwargs ):
+  # Write the message along with its line end at once, so that the lines
+  # printed by worker processes don't get mixed either.
+  line_end = kwargs.pop( "end", "\n" )
+  with _PRINT_LOCK:
+    print( message + line_end, end="", **kwargs )
+    sys.stdout.flush()
 
 
 def Error( message, **kwargs ):
-  print( colorama.Fore.RED + colorama.Style.BRIGHT + "ERROR: " + \
-        colorama.Style.RESET_ALL + str( message ), **kwargs )
-  sys.stdout.flush()
+  _PrintLine( colorama.Fore.RED + colorama.Style.BRIGHT + "ERROR: " + \
+              colorama.Style.RESET_ALL + str( message ), **kwargs )
 
 
 def Warn( message, **kwargs ):
-  print( colorama.Fore.YELLOW + colorama.Style.BRIGHT + "WARNING: " + \
-        colorama.Style.RESET_ALL + str( message ), **kwargs )
-  sys.stdout.flush()
+  _PrintLine( colorama.Fore.YELLOW + colorama.Style.BRIGHT + "WARNING: " + \
+              colorama.Style.RESET_ALL + str( message ), **kwargs )
 
 
 def Info( message, **kwargs ):
-  print( colorama.Fore.GREEN + colorama.Style.BRIGHT + "INFO: " + \
-        colorama.Style.RESET_ALL + str( message ), **kwargs )
-  sys.stdout.flush()
+  _PrintLine( colorama.Fore.GREEN + colorama.Style.BRIGHT + "INFO: " + \
+              colorama.Style.RESET_ALL + str( message ), **kwargs )
 
 
 def Print( message, **kwargs ):
-  print( message, **kwargs )
-  sys.stdout.flush()
+  _PrintLine( message, **kwargs )
 
 
 def HeadPrint( message, **kwargs ):
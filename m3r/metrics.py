@@ -0,0 +1,182 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+
+from m3r.memory import ACCOUNTING_METHOD
+from m3r.memory import MemoryTracker
+from m3r.memory import StageMemory
+from m3r.transport import GetThreadBytesReceived
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+# Stages of the pipeline, in the order they are reported.
+STAGES = (
+  "login",
+  "cosmic_fetch",
+  "ncbi_fetch",
+  "isoform_match",
+  "pdb_load",
+  "align",
+  "map",
+  "write"
+)
+# Linux getrusage() accepts RUSAGE_THREAD, which Python 2 doesn't expose.
+_RUSAGE_THREAD = 1
+_MIB = 1024.0 * 1024.0
+
+
+class StageMetrics( object ):
+  """This class keeps the counters of a single stage: number of calls, wall
+  and CPU time (seconds), items processed, bytes received and cache hits, and
+  memory counters, if memory is tracked."""
+
+  FIELDS = ( "calls", "wall_time", "cpu_time", "items", "bytes", "cache_hits" )
+
+  def __init__( self, track_memory=False ):
+    self.memory = StageMemory() if track_memory else None
+    self.calls = 0
+    self.wall_time = 0.0
+    self.cpu_time = 0.0
+    self.items = 0
+    self.bytes = 0
+    self.cache_hits = 0
+
+  def Add( self, values ):
+    for field in StageMetrics.FIELDS:
+      setattr( self, field, getattr( self, field ) + values.get( field, 0 ) )
+    if self.memory is not None and "memory" in values:
+      self.memory.Add( values["memory"] )
+
+  def ToDict( self ):
+    result = collections.OrderedDict( ( field, getattr( self, field ) )
+                                      for field in StageMetrics.FIELDS )
+    if self.memory is not None:
+      result["memory"] = self.memory.ToDict()
+    return result
+
+
+class StageCounter( object ):
+  """This class is handed to the measured block, which sets the number of
+  items it has processed."""
+
+  def __init__( self ):
+    self.items = 0
+
+
+class Metrics( object ):
+  """This class implements per-stage instrumentation of the pipeline. Stages
+  may be measured concurrently on different threads: CPU time and bytes are
+  taken per thread, where the platform allows it. Metrics of worker processes
+  are merged in as dicts. Memory tracking is opt-in, as it slows the stage
+  boundaries down."""
+
+  def __init__( self, track_memory=False ):
+    self.memory = MemoryTracker() if track_memory else None
+    self.stages = None
+    self._lock = threading.Lock()
+    self.Reset()
+
+  def Reset( self ):
+    track_memory = self.memory is not None
+    with self._lock:
+      self.stages = collections.OrderedDict(
+        ( name, StageMetrics( track_memory ) ) for name in STAGES )
+
+  @contextlib.contextmanager
+  def Measure( self, stage ):
+    counter = StageCounter()
+    snapshot = self.memory.TakeSnapshot() if self.memory is not None else None
+    wall_start = time.time()
+    cpu_start = GetThreadCPUTime()
+    bytes_start = GetThreadBytesReceived()
+    try:
+      yield counter
+    finally:
+      values = {
+        "calls" : 1,
+        "wall_time" : time.time() - wall_start,
+        "cpu_time" : GetThreadCPUTime() - cpu_start,
+        "items" : counter.items,
+        "bytes" : GetThreadBytesReceived() - bytes_start
+      }
+      if self.memory is not None:
+        values["memory"] = self.memory.CompareSnapshots( snapshot )
+      with self._lock:
+        self.stages[stage].Add( values )
+
+  def AddCacheHits( self, stage, count=1 ):
+    with self._lock:
+      self.stages[stage].cache_hits = self.stages[stage].cache_hits + count
+
+  def Merge( self, metrics_dict ):
+    with self._lock:
+      for stage, values in metrics_dict.iteritems():
+        self.stages[stage].Add( values )
+
+  def ToDict( self ):
+    with self._lock:
+      return collections.OrderedDict( ( name, stage.ToDict() ) for name, stage \
+                                      in self.stages.iteritems() )
+
+  def GetSummary( self ):
+    lines = [ "{:<14} {:>6} {:>9} {:>9} {:>9} {:>12} {:>6}".format(
+      "Stage", "Calls", "Wall, s", "CPU, s", "Items", "Bytes", "Hits" ) ]
+    for name, values in self.ToDict().iteritems():
+      lines.append( "{:<14} {:>6} {:>9.2f} {:>9.2f} {:>9} {:>12} {:>6}".format(
+        name, values["calls"], values["wall_time"], values["cpu_time"],
+        values["items"], values["bytes"], values["cache_hits"] ) )
+    return lines
+
+  def GetMemoryReport( self ):
+    lines = [ "{:<14} {:>15} {:>15} {:>15}".format(
+      "Stage", "Allocated, MiB", "RSS growth, MiB", "Peak RSS, MiB" ) ]
+    accounting = ACCOUNTING_METHOD
+    for name, values in self.ToDict().iteritems():
+      if not values["calls"]:
+        continue
+      memory = values["memory"]
+      accounting = memory["accounting"]
+      lines.append( "{:<14} {:>15.2f} {:>15.2f} {:>15.2f}".format(
+        name, memory["allocated"] / _MIB, memory["rss_growth"] / _MIB,
+        memory["peak_rss"] / _MIB ) )
+      for site, size in memory["top_sites"]:
+        lines.append( "  {:>10.2f}  {}".format( size / _MIB, site ) )
+    if accounting != "tracemalloc":
+      lines.append( "Allocated sizes and sites are approximate: tracemalloc " \
+                    "isn't available, so only container objects are " \
+                    "counted, by type. RSS growth includes data buffers." )
+    return lines
+
+
+def GetThreadCPUTime():
+  # CPU time of the calling thread on Linux, of the whole process elsewhere.
+  if resource is not None and sys.platform.startswith( "linux" ):
+    usage = resource.getrusage( getattr( resource, "RUSAGE_THREAD",
+                                         _RUSAGE_THREAD ) )
+    return usage.ru_utime + usage.ru_stime
+  times = os.times()
+  return times[0] + times[1]
@@ -0,0 +1,123 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import array
+import collections
+import csv
+
+# Columns of COSMIC missense mutations export used by the pipeline.
+MUTATION_COLUMNS = (
+  "AA Mutation",
+  "Somatic Status",
+  "Transcript",
+  "Zygosity",
+  "Primary Tissue",
+  "Histology"
+)
+_CHUNK_SIZE = 64 * 1024
+
+
+class CategoryColumn( object ):
+  """This class implements a dictionary-encoded column: every distinct value
+  is stored once, and rows keep integer category codes."""
+
+  def __init__( self ):
+    self.categories = []
+    self.codes = array.array( "i" )
+    self._category_codes = {}
+
+  def Append( self, value ):
+    code = self._category_codes.get( value )
+    if code is None:
+      code = len( self.categories )
+      self._category_codes[value] = code
+      self.categories.append( value )
+    self.codes.append( code )
+
+  def __len__( self ):
+    return len( self.codes )
+
+  def __getitem__( self, index ):
+    return self.categories[self.codes[index]]
+
+  def __iter__( self ):
+    categories = self.categories
+    for code in self.codes:
+      yield categories[code]
+
+
+class MutationTable( object ):
+  """This class implements a compact columnar table of COSMIC mutations. All
+  the columns are dictionary-encoded, as mutation names, tissues, histologies,
+  etc. are highly repetitive for the hot genes."""
+
+  def __init__( self, columns=MUTATION_COLUMNS ):
+    self.columns = collections.OrderedDict()
+    for name in columns:
+      self.columns[name] = CategoryColumn()
+    self._row_count = 0
+
+  def Append( self, values ):
+    for column, value in zip( self.columns.itervalues(), values ):
+      column.Append( value )
+    self._row_count = self._row_count + 1
+
+  def __len__( self ):
+    return self._row_count
+
+  def __contains__( self, name ):
+    return name in self.columns
+
+  def __getitem__( self, name ):
+    return self.columns[name]
+
+
+def IterLines( stream, chunk_size=_CHUNK_SIZE ):
+  # Read the stream in chunks, so that the whole payload is never held in
+  # memory at once.
+  tail = ""
+  while True:
+    chunk = stream.read( chunk_size )
+    if not chunk:
+      break
+    lines = ( tail + chunk ).split( "\n" )
+    tail = lines.pop()
+    for line in lines:
+      yield line + "\n"
+  if tail:
+    yield tail
+
+
+def ReadMutationTable( stream, columns=MUTATION_COLUMNS,
+                       chunk_size=_CHUNK_SIZE ):
+  csvreader = csv.reader( IterLines( stream, chunk_size ), delimiter="\t" )
+  csvheaders = next( csvreader, None )
+  if not csvheaders:
+    return None
+  column_indices = []
+  for name in columns:
+    if name not in csvheaders:
+      return None
+    column_indices.append( csvheaders.index( name ) )
+  table = MutationTable( columns )
+  for row in csvreader:
+    if not row:
+      continue
+    row_size = len( row )
+    table.Append( [ row[i] if i < row_size else "" for i in column_indices ] )
+  return table
@@ -18,39 +18,51 @@
 # ------------------------------------------------------------------------------
 import cookielib
 import json
-import ssl
+import time
+import urllib
 import urllib2
 
-_NCBI_GENE_SEARCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/" \
-                        "esearch.fcgi?db=gene&term=%s&retmax=1&retmode=json" \
-                        "&sort=relevance"
-_NCBI_RSEQ_SEARCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/" \
-                        "elink.fcgi?id=%i&linkname=gene_protein_refseq" \
-                        "&retmode=json"
-_NCBI_RSEQ_FASTA_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/" \
-                        "efetch.fcgi?db=sequences&id=%s&rettype=fasta"
+from m3r.ratelimit import GetTokenBucket
+from m3r.transport import BuildOpener
+
+_NCBI_EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+_NCBI_ORGANISM = "human"
+# E-utilities allow 3 requests per second, or 10 with an API key.
+_NCBI_RATE_LIMIT = 3
+_NCBI_RATE_LIMIT_API_KEY = 10
+_NCBI_BATCH_SIZE = 200
+_NCBI_MAX_GET_LENGTH = 2000
+_NCBI_MAX_RETRIES = 5
+_NCBI_RETRY_CODES = ( 429, 502, 503 )
 
 
 class NCBIDatabase( object ):
   """This class implements access to NCBI database. It supports logging in,
-  retrieving gene data, mutations lists, etc."""
+  retrieving gene data, mutations lists, etc. All the requests go through
+  a rate limiter tuned to the API key, and the batch methods merge many genes
+  into single E-utilities calls."""
 
-  def __init__( self ):
-    self._context = ssl.SSLContext( ssl.PROTOCOL_TLSv1 )
+  def __init__( self, api_key=None, email=None, organism=_NCBI_ORGANISM,
+                url=None ):
+    self._url = ( url or _NCBI_EUTILS_URL ).rstrip( "/" ) + "/"
+    self._api_key = api_key
+    self._email = email
+    self._organism = organism
+    rate_limit = _NCBI_RATE_LIMIT_API_KEY if api_key else _NCBI_RATE_LIMIT
+    self._rate_limiter = GetTokenBucket( "ncbi:%s" % api_key, rate_limit )
     self._cookies = cookielib.CookieJar()
-    self._opener = urllib2.build_opener(
-      urllib2.HTTPRedirectHandler(),
-      urllib2.HTTPHandler( debuglevel=0 ),
-      urllib2.HTTPSHandler( debuglevel=0, context=self._context ),
-      urllib2.HTTPCookieProcessor( self._cookies )
-    )
-    if self._opener is not None:
-      self._opener.addheaders = [ ( "User-agent", "Mozilla/5.0" ) ]
+    self._opener = BuildOpener( self._cookies )
 
   def FindGeneID( self, name ):
     if name is None:
       raise RuntimeError( self._errmsg_empty_gene )
-    data = self._opener.open( _NCBI_GENE_SEARCH_URL % name )
+    data = self._Request( "esearch.fcgi", [
+      ( "db", "gene" ),
+      ( "term", name ),
+      ( "retmax", 1 ),
+      ( "retmode", "json" ),
+      ( "sort", "relevance" )
+    ] )
     jsondata = json.loads( data.read() )
     if not "esearchresult" in jsondata:
       raise RuntimeError( self._errmsg_parse_error )
@@ -62,44 +74,164 @@ class NCBIDatabase( object ):
       return int( id_value )
     raise RuntimeError( self._errmsg_parse_error )
 
+  def FindGeneIDs( self, names ):
+    result = {}
+    for batch in _Batches( names, _NCBI_BATCH_SIZE ):
+      result.update( self._FindGeneIDBatch( batch ) )
+    # Names that are not found by symbol, or are ambiguous, fall back to the
+    # relevance search one by one. Names that aren't found at all are left out.
+    for name in names:
+      if name not in result:
+        try:
+          result[name] = self.FindGeneID( name )
+        except RuntimeError:
+          continue
+    return result
+
   def GetRefSequences( self, gene_id ):
     if gene_id <= 0:
       raise RuntimeError( self._errmsg_invalid_gene )
-    data = self._opener.open( _NCBI_RSEQ_SEARCH_URL % gene_id )
-    jsondata = json.loads( data.read() )
-    if not "linksets" in jsondata:
+    links = self.GetRefSequencesBatch( [ gene_id ] )
+    if gene_id not in links:
       raise RuntimeError( self._errmsg_parse_error )
-    for linkset in jsondata["linksets"]:
-      if not "ids" in linkset or int( linkset["ids"][0] ) != gene_id:
-        continue
-      for linksetdb in linkset["linksetdbs"]:
-        if linksetdb["linkname"] != "gene_protein_refseq":
+    return links[gene_id]
+
+  def GetRefSequencesBatch( self, gene_ids ):
+    # RefSeq proteins are identified by versioned accessions, the same way as
+    # NCBILocalDatabase identifies them, rather than by GIs.
+    result = {}
+    for gene_id in gene_ids:
+      if gene_id <= 0:
+        raise RuntimeError( self._errmsg_invalid_gene )
+    for batch in _Batches( gene_ids, _NCBI_BATCH_SIZE ):
+      # Separate "id" parameters make elink return one linkset per gene.
+      params = [ ( "id", gene_id ) for gene_id in batch ]
+      params.append( ( "linkname", "gene_protein_refseq" ) )
+      params.append( ( "idtype", "acc" ) )
+      params.append( ( "retmode", "json" ) )
+      data = self._Request( "elink.fcgi", params )
+      jsondata = json.loads( data.read() )
+      if not "linksets" in jsondata:
+        raise RuntimeError( self._errmsg_parse_error )
+      for linkset in jsondata["linksets"]:
+        if not "ids" in linkset or not "linksetdbs" in linkset:
           continue
-        return linksetdb["links"]
-    raise RuntimeError( self._errmsg_parse_error )
+        gene_id = int( linkset["ids"][0] )
+        for linksetdb in linkset["linksetdbs"]:
+          if linksetdb["linkname"] != "gene_protein_refseq":
+            continue
+          result[gene_id] = [ str( link ) for link in linksetdb["links"] ]
+          break
+    return result
 
   def GetFASTA( self, refseq_ids ):
+    data = self._Request( "efetch.fcgi", [
+      ( "db", "sequences" ),
+      ( "id", self._JoinRefSeqIDs( refseq_ids ) ),
+      ( "rettype", "fasta" )
+    ] )
+    return _CollectFASTA( _ParseFASTA( data.read() ) )
+
+  def GetFASTABatch( self, refseq_map ):
+    ordered_ids = []
+    known_ids = set()
+    for refseq_ids in refseq_map.itervalues():
+      self._JoinRefSeqIDs( refseq_ids )
+      for refseq_id in refseq_ids:
+        if refseq_id not in known_ids:
+          known_ids.add( refseq_id )
+          ordered_ids.append( refseq_id )
+    # Records are paired with the ids by the ids their headers name, as
+    # efetch doesn't promise to keep the order.
+    records_by_id = {}
+    for batch in _Batches( ordered_ids, _NCBI_BATCH_SIZE ):
+      data = self._Request( "efetch.fcgi", [
+        ( "db", "sequences" ),
+        ( "id", self._JoinRefSeqIDs( batch ) ),
+        ( "rettype", "fasta" )
+      ] )
+      for header, sequence in _ParseFASTA( data.read() ):
+        for record_id in _GetRecordIDs( header ):
+          records_by_id.setdefault( record_id, ( header, sequence ) )
+    if any( str( refseq_id ) not in records_by_id
+            for refseq_id in ordered_ids ):
+      # Records can't be paired with the ids, so fetch them key by key.
+      return dict( ( key, self.GetFASTA( refseq_ids ) )
+                   for key, refseq_ids in refseq_map.iteritems() )
+    result = {}
+    for key, refseq_ids in refseq_map.iteritems():
+      result[key] = _CollectFASTA( records_by_id[str( refseq_id )]
+                                   for refseq_id in refseq_ids )
+    return result
+
+  def _FindGeneIDBatch( self, names ):
+    term = "(%s) AND %s[orgn] AND alive[prop]" % \
+      ( " OR ".join( "%s[sym]" % name for name in names ), self._organism )
+    data = self._Request( "esearch.fcgi", [
+      ( "db", "gene" ),
+      ( "term", term ),
+      ( "retmax", len( names ) * 4 ),
+      ( "retmode", "json" )
+    ] )
+    jsondata = json.loads( data.read() )
+    if not "esearchresult" in jsondata:
+      raise RuntimeError( self._errmsg_parse_error )
+    id_list = jsondata["esearchresult"]["idlist"]
+    if not id_list:
+      return {}
+    data = self._Request( "esummary.fcgi", [
+      ( "db", "gene" ),
+      ( "id", ",".join( id_list ) ),
+      ( "retmode", "json" )
+    ] )
+    jsondata = json.loads( data.read() )
+    if not "result" in jsondata:
+      raise RuntimeError( self._errmsg_parse_error )
+    summary = jsondata["result"]
+    symbol_ids = {}
+    for uid in summary.get( "uids", [] ):
+      symbol = summary[uid].get( "name", "" ).upper()
+      symbol_ids.setdefault( symbol, [] ).append( int( uid ) )
+    result = {}
+    for name in names:
+      gene_ids = symbol_ids.get( name.upper() )
+      if gene_ids and len( gene_ids ) == 1:
+        result[name] = gene_ids[0]
+    return result
+
+  def _JoinRefSeqIDs( self, refseq_ids ):
     if not refseq_ids:
       raise RuntimeError( self._errmsg_empty_refseq )
-    refseq_string = ""
     for refseq_id in refseq_ids:
-      if refseq_id <= 0:
+      if not refseq_id:
         raise RuntimeError( self._errmsg_invalid_refseq )
-      if refseq_string:
-        refseq_string += ","
-      refseq_string += str( refseq_id )
-    data = self._opener.open( _NCBI_RSEQ_FASTA_URL % refseq_string )
-    fastas = data.read().split( "\n\n" )
-    result = {}
-    for fasta in fastas:
-      lines = fasta.splitlines()
-      if not lines or lines[0][0] != '>':
-        continue
-      fasta_value = "".join( lines[1:] )
-      # Ignore duplicate sequences.
-      if fasta_value not in result.values():
-        result[lines[0][1:]] = fasta_value
-    return result
+    return ",".join( str( refseq_id ) for refseq_id in refseq_ids )
+
+  def _Request( self, utility, params ):
+    params = list( params )
+    if self._api_key:
+      params.append( ( "api_key", self._api_key ) )
+    if self._email:
+      params.append( ( "email", self._email ) )
+    query = urllib.urlencode( params )
+    url = self._url + utility
+    for attempt in range( _NCBI_MAX_RETRIES + 1 ):
+      self._rate_limiter.Acquire()
+      try:
+        # Long id lists don't fit into URL, E-utilities accept them via POST.
+        if len( query ) > _NCBI_MAX_GET_LENGTH:
+          return self._opener.open( url, query )
+        return self._opener.open( url + "?" + query )
+      except urllib2.HTTPError as e:
+        if e.code not in _NCBI_RETRY_CODES or attempt == _NCBI_MAX_RETRIES:
+          raise
+        delay = 2 ** attempt
+        retry_after = e.info().getheader( "Retry-After" )
+        if retry_after and retry_after.isdigit():
+          delay = max( delay, int( retry_after ) )
+        e.close()
+        time.sleep( delay )
+    raise RuntimeError( self._errmsg_parse_error )
 
 
   _errmsg_empty_gene = "Gene name is not specified."
@@ -107,3 +239,52 @@ class NCBIDatabase( object ):
   _errmsg_empty_refseq = "RefSequence list is empty."
   _errmsg_invalid_refseq = "RefSequence id is not valid."
   _errmsg_parse_error = "Couldn't parse NCBI response."
+
+
+def _Batches( items, batch_size ):
+  items = list( items )
+  for start in range( 0, len( items ), batch_size ):
+    yield items[start:start + batch_size]
+
+
+def _ParseFASTA( text ):
+  records = []
+  header = None
+  lines = []
+  for line in text.splitlines():
+    if line.startswith( ">" ):
+      if header is not None:
+        records.append( ( header, "".join( lines ) ) )
+      header = line[1:]
+      lines = []
+    elif header is not None:
+      lines.append( line.strip() )
+  if header is not None:
+    records.append( ( header, "".join( lines ) ) )
+  return records
+
+
+def _GetRecordIDs( header ):
+  # Ids the FASTA header names: the accession, with and without version, and
+  # GI of old-style headers, like "gi|4505467|ref|NP_002533.1| ...".
+  name = header.split( " ", 1 )[0]
+  fields = name.split( "|" )
+  record_ids = set( [ name ] )
+  for index in range( len( fields ) - 1 ):
+    if fields[index] in ( "gi", "ref" ) and fields[index + 1]:
+      record_ids.add( fields[index + 1] )
+  for record_id in list( record_ids ):
+    if "|" not in record_id:
+      record_ids.add( record_id.split( "." )[0] )
+  return record_ids
+
+
+def _CollectFASTA( records ):
+  result = {}
+  known_sequences = set()
+  for header, sequence in records:
+    # Ignore duplicate sequences.
+    if sequence not in known_sequences:
+      known_sequences.add( sequence )
+      result[header] = sequence
+  return result
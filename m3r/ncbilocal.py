@@ -0,0 +1,368 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import bisect
+import csv
+import gzip
+import os
+import struct
+import zlib
+
+import m3r.messages as vm
+
+# Index files are stored next to the FASTA file. FAI and GZI files have the
+# same format as the ones built by "samtools faidx".
+_FAI_SUFFIX = ".fai"
+_GZI_SUFFIX = ".gzi"
+_GENES_SUFFIX = ".genes"
+_HUMAN_TAXID = "9606"
+_BGZF_MAGIC = "\x1f\x8b\x08\x04"
+_BGZF_HEADER_SIZE = 12
+_BGZF_FOOTER_SIZE = 8
+_READ_CHUNK_SIZE = 64 * 1024
+_ERRMSG_NOT_BGZF = "\"%s\" is compressed, but not with bgzip."
+_ERRMSG_BAD_BGZF = "\"%s\" has a corrupted BGZF block."
+_ERRMSG_BAD_GENE_TABLE = "\"%s\" is not a gene2refseq table."
+
+
+class NCBILocalDatabase( object ):
+  """This class implements access to a local RefSeq protein FASTA file, indexed
+  by BuildRefSeqIndex. It has the same interface as NCBIDatabase, but reads
+  each sequence by seeking straight to its record."""
+
+  def __init__( self, fasta_path ):
+    if not os.path.isfile( fasta_path ):
+      raise RuntimeError( self._errmsg_no_fasta % fasta_path )
+    fasta_mtime = os.path.getmtime( fasta_path )
+    for suffix in ( _FAI_SUFFIX, _GENES_SUFFIX ):
+      index_path = fasta_path + suffix
+      if not os.path.isfile( index_path ) or \
+         os.path.getmtime( index_path ) < fasta_mtime:
+        raise RuntimeError( self._errmsg_no_index % fasta_path )
+    self._records = _LoadFAI( fasta_path + _FAI_SUFFIX )
+    self._gene_ids, self._gene_proteins, self._descriptions = \
+      _LoadGeneTable( fasta_path + _GENES_SUFFIX )
+    if os.path.isfile( fasta_path + _GZI_SUFFIX ):
+      self._reader = _BGZFReader( fasta_path,
+                                  _LoadGZI( fasta_path + _GZI_SUFFIX ) )
+    else:
+      self._reader = _PlainReader( fasta_path )
+
+  def FindGeneID( self, name ):
+    if name is None:
+      raise RuntimeError( self._errmsg_empty_gene )
+    gene_id = self._gene_ids.get( name.upper() )
+    if gene_id is None:
+      raise RuntimeError( self._errmsg_invalid_gene )
+    return gene_id
+
+  def FindGeneIDs( self, names ):
+    # Names that aren't found are left out.
+    return dict( ( name, self._gene_ids[name.upper()] ) for name in names
+                 if name and name.upper() in self._gene_ids )
+
+  def GetRefSequences( self, gene_id ):
+    if gene_id <= 0:
+      raise RuntimeError( self._errmsg_invalid_gene )
+    if gene_id not in self._gene_proteins:
+      raise RuntimeError( self._errmsg_no_refseq )
+    return self._gene_proteins[gene_id]
+
+  def GetRefSequencesBatch( self, gene_ids ):
+    return dict( ( gene_id, self._gene_proteins[gene_id] )
+                 for gene_id in gene_ids if gene_id in self._gene_proteins )
+
+  def GetFASTA( self, refseq_ids ):
+    if not refseq_ids:
+      raise RuntimeError( self._errmsg_empty_refseq )
+    result = {}
+    known_sequences = set()
+    for accession in refseq_ids:
+      record = self._records.get( accession )
+      if record is None:
+        raise RuntimeError( self._errmsg_invalid_refseq % accession )
+      sequence = self._ReadSequence( record )
+      # Ignore duplicate sequences.
+      if sequence in known_sequences:
+        continue
+      known_sequences.add( sequence )
+      description = self._descriptions.get( accession )
+      header = accession + " " + description if description else accession
+      result[header] = sequence
+    return result
+
+  def GetFASTABatch( self, refseq_map ):
+    return dict( ( key, self.GetFASTA( refseq_ids ) )
+                 for key, refseq_ids in refseq_map.iteritems() )
+
+  def _ReadSequence( self, record ):
+    length, offset, line_bases, line_width = record
+    if not length:
+      return ""
+    line_count = ( length + line_bases - 1 ) // line_bases
+    raw_size = length + ( line_count - 1 ) * ( line_width - line_bases )
+    data = self._reader.Read( offset, raw_size )
+    return data.replace( "\n", "" ).replace( "\r", "" )
+
+
+  _errmsg_no_fasta = "RefSeq FASTA file \"%s\" doesn't exist."
+  _errmsg_no_index = "RefSeq FASTA file \"%s\" isn't indexed or the index is " \
+                     "outdated, run \"m3rindex.py refseq\"."
+  _errmsg_empty_gene = "Gene name is not specified."
+  _errmsg_invalid_gene = "Gene name/id is not valid."
+  _errmsg_no_refseq = "No RefSeq proteins are known for the gene."
+  _errmsg_empty_refseq = "RefSequence list is empty."
+  _errmsg_invalid_refseq = "RefSequence \"%s\" is not in the FASTA file."
+
+
+class _PlainReader( object ):
+  """This class reads byte ranges of an uncompressed file."""
+
+  def __init__( self, path ):
+    self._file = open( path, "rb" )
+
+  def Read( self, offset, size ):
+    self._file.seek( offset )
+    return self._file.read( size )
+
+  def ReadChunks( self ):
+    self._file.seek( 0 )
+    while True:
+      chunk = self._file.read( _READ_CHUNK_SIZE )
+      if not chunk:
+        return
+      yield chunk
+
+
+class _BGZFReader( object ):
+  """This class reads byte ranges of a bgzip-compressed file, given uncompressed
+  offsets. The GZI index maps them to the compressed blocks."""
+
+  def __init__( self, path, blocks ):
+    self._path = path
+    self._file = open( path, "rb" )
+    self._blocks = blocks
+    self._uncompressed_offsets = [ block[1] for block in blocks ]
+
+  def Read( self, offset, size ):
+    block_index = bisect.bisect_right( self._uncompressed_offsets, offset ) - 1
+    compressed_offset, uncompressed_offset = self._blocks[block_index]
+    self._file.seek( compressed_offset )
+    skip = offset - uncompressed_offset
+    chunks = []
+    while size > 0:
+      data = self._ReadBlock()
+      if data is None:
+        break
+      if skip:
+        block_size = len( data )
+        data = data[skip:]
+        skip = max( 0, skip - block_size )
+      chunks.append( data[:size] )
+      size = size - len( chunks[-1] )
+    return "".join( chunks )
+
+  def ReadChunks( self, blocks=None ):
+    self._file.seek( 0 )
+    uncompressed_offset = 0
+    while True:
+      compressed_offset = self._file.tell()
+      data = self._ReadBlock()
+      if data is None:
+        return
+      if blocks is not None and data:
+        blocks.append( ( compressed_offset, uncompressed_offset ) )
+      uncompressed_offset = uncompressed_offset + len( data )
+      yield data
+
+  def _ReadBlock( self ):
+    header = self._file.read( _BGZF_HEADER_SIZE )
+    if not header:
+      return None
+    if len( header ) < _BGZF_HEADER_SIZE or header[:4] != _BGZF_MAGIC:
+      raise RuntimeError( _ERRMSG_BAD_BGZF % self._path )
+    extra_size = struct.unpack( "<H", header[10:12] )[0]
+    extra = self._file.read( extra_size )
+    block_size = None
+    position = 0
+    while position + 4 <= extra_size:
+      field_id = extra[position:position + 2]
+      field_size = struct.unpack( "<H", extra[position + 2:position + 4] )[0]
+      if field_id == "BC" and field_size == 2:
+        block_size = struct.unpack( "<H", extra[position + 4:position + 6] )[0]
+      position = position + 4 + field_size
+    if block_size is None:
+      raise RuntimeError( _ERRMSG_BAD_BGZF % self._path )
+    data_size = block_size + 1 - _BGZF_HEADER_SIZE - extra_size - \
+                _BGZF_FOOTER_SIZE
+    compressed = self._file.read( data_size )
+    self._file.read( _BGZF_FOOTER_SIZE )
+    return zlib.decompress( compressed, -zlib.MAX_WBITS )
+
+
+def BuildRefSeqIndex( fasta_path, gene2refseq_path, taxid=_HUMAN_TAXID ):
+  with open( fasta_path, "rb" ) as file_object:
+    magic = file_object.read( 4 )
+  blocks = None
+  if magic[:2] == _BGZF_MAGIC[:2]:
+    if magic != _BGZF_MAGIC:
+      raise RuntimeError( _ERRMSG_NOT_BGZF % fasta_path )
+    reader = _BGZFReader( fasta_path, [] )
+    blocks = []
+    chunks = reader.ReadChunks( blocks )
+  else:
+    chunks = _PlainReader( fasta_path ).ReadChunks()
+
+  vm.Info( "Indexing \"%s\"..." % fasta_path )
+  descriptions = {}
+  with open( fasta_path + _FAI_SUFFIX, "w" ) as fai_file:
+    for record in _ScanFASTA( chunks ):
+      name, description = record[0], record[1]
+      descriptions[name] = description
+      fai_file.write( "%s\t%i\t%i\t%i\t%i\n" % ( ( name, ) + record[2:] ) )
+  if blocks is not None:
+    with open( fasta_path + _GZI_SUFFIX, "wb" ) as gzi_file:
+      # The first block always starts at zero, and isn't stored.
+      gzi_file.write( struct.pack( "<Q", len( blocks ) - 1 ) )
+      for compressed_offset, uncompressed_offset in blocks[1:]:
+        gzi_file.write( struct.pack( "<QQ", compressed_offset,
+                                     uncompressed_offset ) )
+  elif os.path.isfile( fasta_path + _GZI_SUFFIX ):
+    os.remove( fasta_path + _GZI_SUFFIX )
+
+  vm.Info( "Building gene table from \"%s\"..." % gene2refseq_path )
+  gene_count = 0
+  with open( fasta_path + _GENES_SUFFIX, "w" ) as genes_file:
+    for symbol, gene_id, accession in \
+        _ScanGeneTable( gene2refseq_path, taxid, descriptions ):
+      genes_file.write( "%s\t%s\t%s\t%s\n" % \
+                        ( symbol, gene_id, accession, descriptions[accession] ) )
+      gene_count = gene_count + 1
+  return len( descriptions ), gene_count
+
+
+def _ScanFASTA( chunks ):
+  # Yields (name, description, length, offset, line bases, line width) per
+  # FASTA record.
+  record = []
+  offset = 0
+  tail = ""
+  for chunk in chunks:
+    lines = ( tail + chunk ).split( "\n" )
+    tail = lines.pop()
+    for line in lines:
+      line_width = len( line ) + 1
+      if line.startswith( ">" ):
+        if record:
+          yield tuple( record )
+        name, _, description = line[1:].rstrip( "\r" ).partition( " " )
+        record = [ _AccessionFromName( name ), description.strip(), 0,
+                   offset + line_width, 0, 0 ]
+      elif record:
+        _AddFASTALine( record, len( line.rstrip( "\r" ) ), line_width )
+      offset = offset + line_width
+  if record:
+    if tail and not tail.startswith( ">" ):
+      line_bases = len( tail.rstrip( "\r" ) )
+      _AddFASTALine( record, line_bases, line_bases + 1 )
+    yield tuple( record )
+
+
+def _AddFASTALine( record, line_bases, line_width ):
+  if not record[4]:
+    record[4] = line_bases
+    record[5] = line_width
+  record[2] = record[2] + line_bases
+
+
+def _AccessionFromName( name ):
+  # Old-style headers look like "gi|4505467|ref|NP_002533.1|".
+  if "|" not in name:
+    return name
+  fields = name.split( "|" )
+  if "ref" in fields:
+    ref_index = fields.index( "ref" )
+    if ref_index + 1 < len( fields ) and fields[ref_index + 1]:
+      return fields[ref_index + 1]
+  return name
+
+
+def _ScanGeneTable( gene2refseq_path, taxid, accessions ):
+  if gene2refseq_path.endswith( ".gz" ):
+    table_file = gzip.open( gene2refseq_path, "rb" )
+  else:
+    table_file = open( gene2refseq_path, "rb" )
+  with table_file:
+    csvreader = csv.reader( table_file, delimiter="\t" )
+    csvheaders = next( csvreader, None )
+    if not csvheaders:
+      raise RuntimeError( _ERRMSG_BAD_GENE_TABLE % gene2refseq_path )
+    csvheaders[0] = csvheaders[0].lstrip( "#" )
+    try:
+      taxid_index = csvheaders.index( "tax_id" )
+      gene_index = csvheaders.index( "GeneID" )
+      protein_index = csvheaders.index( "protein_accession.version" )
+      symbol_index = csvheaders.index( "Symbol" )
+    except ValueError:
+      raise RuntimeError( _ERRMSG_BAD_GENE_TABLE % gene2refseq_path )
+    last_index = max( taxid_index, gene_index, protein_index, symbol_index )
+    known_pairs = set()
+    for row in csvreader:
+      if len( row ) <= last_index or row[taxid_index] != taxid:
+        continue
+      accession = row[protein_index]
+      if accession not in accessions:
+        continue
+      pair = ( row[gene_index], accession )
+      if pair in known_pairs:
+        continue
+      known_pairs.add( pair )
+      yield row[symbol_index], row[gene_index], accession
+
+
+def _LoadFAI( fai_path ):
+  records = {}
+  with open( fai_path, "r" ) as fai_file:
+    for line in fai_file:
+      fields = line.rstrip( "\n" ).split( "\t" )
+      records[fields[0]] = tuple( int( field ) for field in fields[1:5] )
+  return records
+
+
+def _LoadGZI( gzi_path ):
+  blocks = [ ( 0, 0 ) ]
+  with open( gzi_path, "rb" ) as gzi_file:
+    block_count = struct.unpack( "<Q", gzi_file.read( 8 ) )[0]
+    for _ in range( block_count ):
+      blocks.append( struct.unpack( "<QQ", gzi_file.read( 16 ) ) )
+  return blocks
+
+
+def _LoadGeneTable( genes_path ):
+  gene_ids = {}
+  gene_proteins = {}
+  descriptions = {}
+  with open( genes_path, "r" ) as genes_file:
+    for line in genes_file:
+      symbol, gene_id, accession, description = \
+        line.rstrip( "\n" ).split( "\t", 3 )
+      gene_id = int( gene_id )
+      gene_ids.setdefault( symbol.upper(), gene_id )
+      gene_proteins.setdefault( gene_id, [] ).append( accession )
+      descriptions[accession] = description
+  return gene_ids, gene_proteins, descriptions
@@ -0,0 +1,98 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import hashlib
+import json
+import os
+
+OUTPUT_MANIFEST_COLUMNS = ( "mutation", "path", "sha1", "params" )
+_HASH_CHUNK_SIZE = 64 * 1024
+
+
+class OutputManifest( object ):
+  """This class implements an append-only manifest of the saved models. Every
+  record keeps the mutation, output path, SHA-1 of the file content and the
+  parameters the model was generated with (as JSON). The latest record of a
+  path wins, so that reruns can skip the models which are already saved."""
+
+  def __init__( self, path ):
+    self.path = path
+    self._records = {}
+    self._seeds = {}
+
+  def Load( self ):
+    if not os.path.isfile( self.path ):
+      return self
+    with open( self.path ) as stream:
+      for line in stream:
+        fields = line.rstrip( "\r\n" ).split( "\t" )
+        if len( fields ) != len( OUTPUT_MANIFEST_COLUMNS ) or \
+           fields[0] == OUTPUT_MANIFEST_COLUMNS[0]:
+          continue
+        mutation, output_path, sha1, params = fields
+        try:
+          params = json.loads( params )
+        except ValueError:
+          continue
+        self._records[output_path] = ( mutation, sha1, params )
+        if isinstance( params, dict ) and "seed" in params:
+          self._seeds[( params.get( "gene" ), params.get( "chain" ) )] = \
+            params["seed"]
+    return self
+
+  def GetSeed( self, genename, chainid ):
+    # Sampling seed of the latest model saved for the gene and chain.
+    return self._seeds.get( ( genename, chainid ) )
+
+  def IsSaved( self, output_path, params ):
+    record = self._records.get( output_path )
+    if record is None or record[2] != params:
+      return False
+    if not os.path.isfile( output_path ):
+      return False
+    return HashFile( output_path ) == record[1]
+
+  def Add( self, mutation, output_path, sha1, params ):
+    line = "\t".join( ( mutation, output_path, sha1,
+                        json.dumps( params, sort_keys=True ) ) ) + "\n"
+    if not os.path.isfile( self.path ):
+      line = "\t".join( OUTPUT_MANIFEST_COLUMNS ) + "\n" + line
+    # The record is appended with a single write, so that the records of
+    # concurrent worker processes don't get mixed.
+    descriptor = os.open( self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0644 )
+    try:
+      os.write( descriptor, line )
+    finally:
+      os.close( descriptor )
+    self._records[output_path] = ( mutation, sha1, params )
+
+
+def HashFile( path ):
+  sha1 = hashlib.sha1()
+  with open( path, "rb" ) as stream:
+    for chunk in iter( lambda: stream.read( _HASH_CHUNK_SIZE ), "" ):
+      sha1.update( chunk )
+  return sha1.hexdigest()
+
+
+def ReplaceFile( source_path, target_path ):
+  # os.rename() doesn't replace existing file on Windows.
+  if os.name == "nt" and os.path.exists( target_path ):
+    os.remove( target_path )
+  os.rename( source_path, target_path )
@@ -16,6 +16,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 # ------------------------------------------------------------------------------
+import copy
+
 _AA_MAP = {
   "ALA": "A",
   "ARG": "R",
@@ -74,9 +76,10 @@ _AA_BACKBONE = [ " N  ", " C  ", " CA ", " O  " ]
 
 class PDBFile( object ):
   """This class implements PDB file interface. It supports reading, writing,
-  getting FASTA, etc."""
+  getting FASTA, etc. A single chain may be loaded, leaving the atoms of the
+  other chains out."""
 
-  def __init__( self, filename=None ):
+  def __init__( self, filename=None, chainid=None ):
     self.atoms = {}
     self.chains = {}
     self.remarks = []
@@ -85,9 +88,9 @@ class PDBFile( object ):
     self._filename = ""
     self._linecount = 0
     if filename:
-      self.Load( filename )
+      self.Load( filename, chainid )
 
-  def Load( self, filename ):
+  def Load( self, filename, chainid=None ):
     self._filename = filename
     self._linecount = 1
     self._chain_custom = False
@@ -96,7 +99,12 @@ class PDBFile( object ):
       while line:
         header = line[:6].rstrip()
         if header == "ATOM":
-          self._ParseAtomDesc( line )
+          # Chains are kept as they are named, if any of them isn't "A", even
+          # if it's left out.
+          if line[21:22] not in ( "", "A" ):
+            self._chain_custom = True
+          if chainid is None or line[21:22] == chainid:
+            self._ParseAtomDesc( line )
         elif header == "TER":
           self._chain_index = self._chain_index + 1
         elif header == "END":
@@ -135,6 +143,19 @@ class PDBFile( object ):
         file_object.write( line )
       file_object.write( "{:6}{:5d}\nEND\n".format( "TER", current_serial ) )
 
+  def Copy( self ):
+    # Copy to be mutated. Atoms are shared with the original, MutateAA()
+    # replaces the ones it changes, which is much cheaper than deep copy.
+    result = copy.copy( self )
+    result.atoms = self.atoms.copy()
+    result.chains = {}
+    for chainid, chain in self.chains.iteritems():
+      result.chains[chainid] = dict( chain )
+      if "residues" in chain:
+        result.chains[chainid]["residues"] = dict( chain["residues"] )
+    result.remarks = list( self.remarks )
+    return result
+
   def GetFASTA( self, chainid ):
     fasta = ""
     if not chainid in self.chains:
@@ -171,8 +192,10 @@ class PDBFile( object ):
                          ( self._filename, residue_dict[resid], resid,
                            aafrom_1let ) )
     residue_dict[resid] = aato_3let
-    # Remove AA atoms, except the backbone.
+    # Remove AA atoms, except the backbone. Changed atoms are copied, as they
+    # may be shared with another PDB file.
     stale_serials = []
+    mutated_atoms = {}
     for key, value in self.atoms.iteritems():
       if value["chain"] != chainid or value["resid"] != resid:
         continue
@@ -182,7 +205,8 @@ class PDBFile( object ):
          not ( atom_title == " CB " and aato_3let != "GLY" ):
         stale_serials.append( key )
         continue
-      value["residue"] = aato_3let
+      mutated_atoms[key] = dict( value, residue=aato_3let )
+    self.atoms.update( mutated_atoms )
     if stale_serials:
       for stale_serial in stale_serials:
         del self.atoms[stale_serial]
@@ -0,0 +1,138 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import os
+import re
+
+from m3r.aligners import ALIGN_BANDED
+from m3r.aligners import ALIGN_FULL
+from m3r.aligners import ALIGN_LINEAR
+from m3r.aligners import GetAlignmentMemory
+
+# PDB file loading modes: all the chains, or the chain of the job only.
+LOAD_FULL = "full"
+LOAD_CHAIN = "chain"
+
+# Memory of a process before it loads any data, bytes.
+_PROCESS_MEMORY = 64 * 1024 * 1024
+# Memory taken by a loaded atom, and the size of its line in PDB file, bytes.
+_ATOM_MEMORY = 1700
+_ATOM_LINE_SIZE = 81
+# Average number of atoms of a residue, to estimate PDB sequence length.
+_RESIDUE_ATOMS = 8
+# Share of the process budget the alignment may take, the rest is left to the
+# fetched and loaded data.
+_ALIGNMENT_SHARE = 0.5
+_SIZE_RE = re.compile( r"^\s*(\d+(?:\.\d*)?)\s*([KMGT]?)I?B?\s*$",
+                       re.IGNORECASE )
+_SIZE_UNITS = { "": 0, "K": 1, "M": 2, "G": 3, "T": 4 }
+
+
+class ExecutionPlanner( object ):
+  """This class implements the execution planner. By the input sizes, it picks
+  the number of worker processes, how PDB files are loaded and how sequences
+  are aligned, so that the run fits into the memory budget (bytes, None if
+  it's unlimited) and takes as many CPUs as the CPU budget allows. Budget of a
+  single process, the main one or a worker, is passed to the loading and the
+  alignment plans explicitly, as workers plan on their own."""
+
+  def __init__( self, memory_budget=None, cpu_budget=1 ):
+    self.memory_budget = memory_budget
+    self.cpu_budget = cpu_budget
+
+  def PlanWorkers( self, num_tasks, pdbnames, num_workers=None,
+                   ref_lengths=None ):
+    # Worker processes: as many as requested, or as the CPU budget allows, but
+    # no more than there are tasks to spread (jobs, or mapped mutants of a
+    # single job), and than the memory budget holds. One means no process
+    # pool. Ref. sequence lengths are given, if workers align them.
+    if num_workers is None:
+      num_workers = self.cpu_budget
+    num_workers = max( 1, min( num_workers, num_tasks ) )
+    if self.memory_budget is not None and num_workers > 1:
+      # Main process keeps a PDB file, and every worker keeps it along with
+      # the mutant being saved, and keeps at least the banded alignment of
+      # the longest ref. sequence.
+      pdb_memory = max( [ EstimatePDBMemory( pdbname )
+                          for pdbname in pdbnames ] or [ 0 ] )
+      worker_memory = _PROCESS_MEMORY + 2 * pdb_memory
+      if ref_lengths:
+        pdb_length = pdb_memory // _ATOM_MEMORY // _RESIDUE_ATOMS
+        worker_memory += GetAlignmentMemory( ALIGN_BANDED, max( ref_lengths ),
+                                             pdb_length )
+      num_fitting = ( self.memory_budget - _PROCESS_MEMORY - pdb_memory ) // \
+                    worker_memory
+      num_workers = max( 1, min( num_workers, num_fitting ) )
+    return num_workers
+
+  def GetProcessBudget( self, num_workers ):
+    # Memory budget is shared by the main process and the workers evenly.
+    if self.memory_budget is None:
+      return None
+    num_processes = num_workers + 1 if num_workers > 1 else 1
+    return self.memory_budget // num_processes
+
+  def PlanLoading( self, pdbname, budget ):
+    # Only the chain of the job is loaded, if the whole file doesn't fit into
+    # the process budget.
+    if budget is None or \
+       _PROCESS_MEMORY + EstimatePDBMemory( pdbname ) <= budget:
+      return LOAD_FULL
+    return LOAD_CHAIN
+
+  def PlanAlignment( self, ref_length, pdb_length, budget ):
+    # Full matrix gives the best alignment the fastest, banded one gives the
+    # same, unless the best alignment strays far from the diagonal, and
+    # linear-space one takes twice as long.
+    if budget is None:
+      return ALIGN_FULL
+    budget = ( budget - _PROCESS_MEMORY ) * _ALIGNMENT_SHARE
+    for mode in ( ALIGN_FULL, ALIGN_BANDED ):
+      if GetAlignmentMemory( mode, ref_length, pdb_length ) <= budget:
+        return mode
+    return ALIGN_LINEAR
+
+  def GetDescription( self, num_workers ):
+    memory_budget = "unlimited"
+    if self.memory_budget is not None:
+      memory_budget = FormatSize( self.memory_budget )
+    num_processes = num_workers + 1 if num_workers > 1 else 1
+    return "%i process(es), memory budget %s, CPU budget %i" % \
+           ( num_processes, memory_budget, self.cpu_budget )
+
+
+def EstimatePDBMemory( pdbname ):
+  # Memory the loaded PDB file takes, by its size, bytes.
+  try:
+    return os.path.getsize( pdbname ) // _ATOM_LINE_SIZE * _ATOM_MEMORY
+  except OSError:
+    return 0
+
+
+def ParseSize( text ):
+  # Size as a number of bytes, with optional K, M, G or T suffix (powers of
+  # 1024), e.g. 512M or 1.5G. Returns None, if it's not valid.
+  match = _SIZE_RE.match( text )
+  if match is None:
+    return None
+  value, unit = match.groups()
+  return int( float( value ) * 1024 ** _SIZE_UNITS[unit.upper()] )
+
+
+def FormatSize( size ):
+  return "%.1f MiB" % ( size / 1024.0 / 1024.0 )
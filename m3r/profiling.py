@@ -0,0 +1,144 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import collections
+import cProfile
+import os
+import pstats
+import signal
+import sys
+
+import m3r.messages as vm
+
+PROFILE_OPTION = "--profile"
+SAMPLING_OPTION = "--profile-sampling"
+# Number of hot spots printed.
+_TOP_COUNT = 25
+# Stack sampling interval, seconds of CPU time.
+_SAMPLING_INTERVAL = 0.005
+
+
+class Profiler( object ):
+  """This class implements deterministic profiling of the entry point with
+  cProfile. The stats are saved in pstats format, and the top hot spots by
+  cumulative time are printed."""
+
+  def __init__( self, path ):
+    self.path = path
+
+  def Run( self, function ):
+    profile = cProfile.Profile()
+    try:
+      return profile.runcall( function )
+    finally:
+      profile.dump_stats( self.path )
+      vm.Print( vm.HR_LINE )
+      vm.Info( "Profile saved to \"%s\"." % self.path )
+      stats = pstats.Stats( profile, stream=sys.stdout )
+      stats.sort_stats( "cumulative" ).print_stats( _TOP_COUNT )
+
+
+class SamplingProfiler( object ):
+  """This class implements statistical profiling of the entry point: the stack
+  of the main thread is sampled on a CPU time timer signal, which costs much
+  less than tracing every call. Samples are saved as collapsed stacks (one
+  "caller;callee count" line per stack, as flame graph tools take them), and
+  the functions found on most of the stacks are printed."""
+
+  def __init__( self, path, interval=_SAMPLING_INTERVAL ):
+    self.path = path
+    self.interval = interval
+    self.samples = collections.Counter()
+
+  def Run( self, function ):
+    old_handler = signal.signal( signal.SIGPROF, self._Sample )
+    # Restart system calls the signal interrupts, instead of failing them.
+    signal.siginterrupt( signal.SIGPROF, False )
+    signal.setitimer( signal.ITIMER_PROF, self.interval, self.interval )
+    try:
+      return function()
+    finally:
+      signal.setitimer( signal.ITIMER_PROF, 0 )
+      signal.signal( signal.SIGPROF, old_handler )
+      self._Report()
+
+  def _Sample( self, _signum, frame ):
+    stack = []
+    while frame is not None:
+      code = frame.f_code
+      stack.append( "%s:%s:%i" % ( os.path.basename( code.co_filename ),
+                                   code.co_name, code.co_firstlineno ) )
+      frame = frame.f_back
+    stack.reverse()
+    self.samples[tuple( stack )] += 1
+
+  def _Report( self ):
+    with open( self.path, "w" ) as stream:
+      for stack, count in self.samples.most_common():
+        stream.write( "%s %i\n" % ( ";".join( stack ), count ) )
+    num_samples = sum( self.samples.itervalues() )
+    vm.Print( vm.HR_LINE )
+    vm.Info( "%i stack samples saved to \"%s\"." % ( num_samples, self.path ) )
+    if not num_samples:
+      return
+    # A function is counted once per sample it's found in, at any depth.
+    cumulative = collections.Counter()
+    for stack, count in self.samples.iteritems():
+      for function_name in set( stack ):
+        cumulative[function_name] += count
+    vm.Print( "{:>8} {:>7}  {}".format( "Samples", "Cumul.", "Function" ) )
+    for function_name, count in cumulative.most_common( _TOP_COUNT ):
+      vm.Print( "{:>8} {:>6.1f}%  {}".format(
+        count, count * 100.0 / num_samples, function_name ) )
+
+
+def GetProfiler( argv ):
+  # Profile options are taken out of the command line, like --nobanner, before
+  # the script parses it: "--profile[=path]" turns profiling on, and
+  # "--profile-sampling" selects the sampling profiler.
+  path = None
+  is_sampling = False
+  for arg in list( argv[1:] ):
+    if arg == PROFILE_OPTION or arg.startswith( PROFILE_OPTION + "=" ):
+      path = arg[len( PROFILE_OPTION ) + 1:]
+      argv.remove( arg )
+    elif arg == SAMPLING_OPTION:
+      is_sampling = True
+      argv.remove( arg )
+  if path is None and not is_sampling:
+    return None
+  if is_sampling and not hasattr( signal, "setitimer" ):
+    vm.Warn( "Sampling profiler isn't supported on this platform, " \
+             "running cProfile instead." )
+    is_sampling = False
+  if not path:
+    script_name = os.path.splitext( os.path.basename( argv[0] ) )[0]
+    path = script_name + ( ".stacks" if is_sampling else ".prof" )
+  # Scripts may change the working directory.
+  path = os.path.abspath( path )
+  if is_sampling:
+    return SamplingProfiler( path )
+  return Profiler( path )
+
+
+def ProfileMain( main_function, argv=None ):
+  # Run the entry point, under profiler if it's requested on the command line.
+  profiler = GetProfiler( sys.argv if argv is None else argv )
+  if profiler is None:
+    return main_function()
+  return profiler.Run( main_function )
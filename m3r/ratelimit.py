@@ -0,0 +1,68 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import threading
+import time
+
+_SHARED_BUCKETS = {}
+_SHARED_LOCK = threading.Lock()
+
+
+class TokenBucket( object ):
+  """This class implements a thread-safe token bucket rate limiter. Tokens are
+  refilled at the given rate (per second), up to the bucket capacity. Capacity
+  is a single token by default, so that requests are evenly spaced and never
+  go over the rate in any second, even in a burst after an idle period."""
+
+  def __init__( self, rate, capacity=1 ):
+    if rate <= 0:
+      raise RuntimeError( self._errmsg_invalid_rate )
+    self.rate = float( rate )
+    self.capacity = float( capacity )
+    self._tokens = self.capacity
+    self._timestamp = time.time()
+    self._lock = threading.Lock()
+
+  def Acquire( self, tokens=1 ):
+    while True:
+      with self._lock:
+        self._Refill()
+        if self._tokens >= tokens:
+          self._tokens = self._tokens - tokens
+          return
+        delay = ( tokens - self._tokens ) / self.rate
+      time.sleep( delay )
+
+  def _Refill( self ):
+    now = time.time()
+    elapsed = now - self._timestamp
+    self._timestamp = now
+    if elapsed > 0:
+      self._tokens = min( self.capacity, self._tokens + elapsed * self.rate )
+
+
+  _errmsg_invalid_rate = "Rate limit must be positive."
+
+
+def GetTokenBucket( name, rate ):
+  # All the clients of the same service share one bucket per process.
+  key = ( name, rate )
+  with _SHARED_LOCK:
+    if key not in _SHARED_BUCKETS:
+      _SHARED_BUCKETS[key] = TokenBucket( rate )
+    return _SHARED_BUCKETS[key]
@@ -0,0 +1,84 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import heapq
+import random
+
+# Sampling modes: uniform, or weighted by COSMIC recurrence of the mutation,
+# overall or in the given tissue.
+SAMPLING_UNIFORM = "uniform"
+SAMPLING_RECURRENCE = "recurrence"
+SAMPLING_TISSUE = "tissue"
+SAMPLING_MODES = ( SAMPLING_UNIFORM, SAMPLING_RECURRENCE, SAMPLING_TISSUE )
+
+
+def ReservoirSample( items, sample_size, generator=random ):
+  # Uniform sample of the items in a single pass (algorithm R), only the
+  # sample is kept in memory.
+  reservoir = []
+  for count, item in enumerate( items ):
+    if count < sample_size:
+      reservoir.append( item )
+      continue
+    slot = generator.randint( 0, count )
+    if slot < sample_size:
+      reservoir[slot] = item
+  return reservoir
+
+
+def WeightedSample( weighted_items, sample_size, generator=random ):
+  # Weighted sample without replacement of (item, weight) pairs in a single
+  # pass (A-Res): every item gets u ** (1 / weight) key, and the items with
+  # the largest keys are kept in a heap. Items of zero weight are never
+  # picked.
+  heap = []
+  if sample_size <= 0:
+    return []
+  for item, weight in weighted_items:
+    if weight <= 0:
+      continue
+    key = generator.random() ** ( 1.0 / weight )
+    if len( heap ) < sample_size:
+      heapq.heappush( heap, ( key, item ) )
+    elif key > heap[0][0]:
+      heapq.heapreplace( heap, ( key, item ) )
+  return [ item for _, item in heap ]
+
+
+def SampleIndices( count, sample_size, seed=None, weights=None ):
+  # Sorted sample of indices in range( count ). Seeded sample depends on the
+  # seed, count and weights only, so that it's the same in every run and
+  # every process.
+  generator = random.Random( seed ) if seed is not None else random
+  if weights is None:
+    indices = ReservoirSample( xrange( count ), sample_size, generator )
+  else:
+    indices = WeightedSample( enumerate( weights ), sample_size, generator )
+  indices.sort()
+  return indices
+
+
+def ParseShard( text ):
+  # Shard is given as "i/N", where 0 <= i < N.
+  try:
+    shard_index, shard_count = [ int( value ) for value in text.split( "/" ) ]
+  except ValueError:
+    return None
+  if shard_count < 1 or shard_index < 0 or shard_index >= shard_count:
+    return None
+  return shard_index, shard_count
@@ -0,0 +1,69 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import sys
+import threading
+
+
+class Task( object ):
+  """This class runs a function on a separate thread, and keeps either its
+  result or the error it has raised, so that the caller can report errors per
+  task."""
+
+  def __init__( self, name, function, *args, **kwargs ):
+    self.name = name
+    self.result = None
+    self.error = None
+    self.exc_info = None
+    self._function = function
+    self._args = args
+    self._kwargs = kwargs
+    self._thread = threading.Thread( target=self._Run, name=name )
+    self._thread.daemon = True
+
+  def Start( self ):
+    self._thread.start()
+
+  def Wait( self ):
+    # Join with a timeout, so that the main thread stays responsive to Ctrl+C.
+    while self._thread.is_alive():
+      self._thread.join( 0.1 )
+    return self.result
+
+  def _Run( self ):
+    try:
+      self.result = self._function( *self._args, **self._kwargs )
+    except Exception as e:  # pylint: disable=broad-except
+      self.error = e
+      self.exc_info = sys.exc_info()
+
+
+def RunTasks( tasks ):
+  for task in tasks:
+    task.Start()
+  for task in tasks:
+    task.Wait()
+  return [ task for task in tasks if task.error is not None ]
+
+
+def WaitAsyncResult( result ):
+  # Wait for process pool result with a timeout, so that the main thread stays
+  # responsive to Ctrl+C.
+  while not result.ready():
+    result.wait( 0.1 )
+  return result.get()
@@ -0,0 +1,331 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+import httplib
+import io
+import socket
+import ssl
+import threading
+import urllib2
+import zlib
+
+_MAX_CONNECTIONS_PER_HOST = 4
+_USER_AGENT = "Mozilla/5.0"
+_ACCEPT_ENCODING = "gzip, deflate"
+_DECODE_CHUNK_SIZE = 16 * 1024
+# Requests that can be repeated on a fresh connection, if the idle one they've
+# been sent on turns out to be dropped by the server.
+_IDEMPOTENT_METHODS = ( "GET", "HEAD", "OPTIONS", "PUT", "DELETE" )
+# Window bits of zlib decompressor per content encoding.
+_DECODERS = {
+  "gzip": 16 + zlib.MAX_WBITS,
+  "x-gzip": 16 + zlib.MAX_WBITS,
+  "deflate": zlib.MAX_WBITS
+}
+
+_SHARED_POOL = None
+_SHARED_SSL_CONTEXT = None
+_SHARED_LOCK = threading.Lock()
+# Bytes received by the current thread, for per-stage accounting.
+_THREAD_COUNTERS = threading.local()
+
+
+class ConnectionPool( object ):
+  """This class implements a pool of persistent (keep-alive) HTTP connections.
+  There are up to a bounded number of connections per host: requests over the
+  limit wait for a connection to be released. Idle connections are reused by
+  the following requests to the same host. The pool also counts the bytes
+  received, as they come from the wire (before decompression)."""
+
+  def __init__( self, max_per_host=_MAX_CONNECTIONS_PER_HOST ):
+    self.max_per_host = max_per_host
+    self.connections_created = 0
+    self.connections_reused = 0
+    self.bytes_received = 0
+    self._idle = {}
+    self._slots = {}
+    self._lock = threading.Lock()
+
+  def Open( self, http_class, req, debuglevel=0, **http_conn_args ):
+    host = req.get_host()
+    if not host:
+      raise urllib2.URLError( "no host given" )
+    # Request through HTTPS proxy goes to the proxy host, and its connection
+    # is tunneled to the target host, as urllib2 does it.
+    tunnel_host = req._tunnel_host  # pylint: disable=protected-access
+    key = ( http_class.__name__, host, tunnel_host )
+    headers = dict( req.unredirected_hdrs )
+    headers.update( dict( ( k, v ) for k, v in req.headers.items()
+                          if k not in headers ) )
+    headers["Connection"] = "keep-alive"
+    headers = dict( ( name.title(), val ) for name, val in headers.items() )
+    headers.setdefault( "Accept-Encoding", _ACCEPT_ENCODING )
+    tunnel_headers = {}
+    if tunnel_host and "Proxy-Authorization" in headers:
+      tunnel_headers["Proxy-Authorization"] = \
+        headers.pop( "Proxy-Authorization" )
+
+    # The slot is held until the response is read or closed.
+    slot = self._GetSlot( key )
+    slot.acquire()
+    is_sent = False
+    try:
+      connection, response = self._Send( http_class, key, req, headers,
+                                         tunnel_headers, debuglevel,
+                                         http_conn_args )
+      is_sent = True
+    finally:
+      if not is_sent:
+        slot.release()
+
+    # Wrap the response into a buffered reader, so that the result has
+    # readline() and readlines() methods. Closing (or fully reading) it
+    # returns the connection back to the pool. Compressed body is decoded on
+    # the fly, as it's read.
+    raw_response = _PooledResponse( self, key, connection, response )
+    encoding = ( response.getheader( "Content-Encoding" ) or "" ).strip()
+    if encoding.lower() in _DECODERS:
+      raw_response = _DecodedResponse( raw_response, encoding.lower() )
+      del response.msg["Content-Encoding"]
+      del response.msg["Content-Length"]
+    file_object = io.BufferedReader( raw_response )
+    result = urllib2.addinfourl( file_object, response.msg,
+                                 req.get_full_url() )
+    result.code = response.status
+    result.msg = response.reason
+    return result
+
+  def AddBytesReceived( self, size ):
+    with self._lock:
+      self.bytes_received = self.bytes_received + size
+    _THREAD_COUNTERS.bytes_received = GetThreadBytesReceived() + size
+
+  def Release( self, key, connection, reusable=True ):
+    with self._lock:
+      idle_list = self._idle.setdefault( key, [] )
+      if reusable and len( idle_list ) < self.max_per_host:
+        idle_list.append( connection )
+        connection = None
+    if connection is not None:
+      connection.close()
+    self._GetSlot( key ).release()
+
+  def Clear( self ):
+    with self._lock:
+      idle_lists = self._idle.values()
+      self._idle = {}
+    for idle_list in idle_lists:
+      for connection in idle_list:
+        connection.close()
+
+  def _Acquire( self, key ):
+    with self._lock:
+      idle_list = self._idle.get( key )
+      if idle_list:
+        return idle_list.pop()
+    return None
+
+  def _GetSlot( self, key ):
+    with self._lock:
+      if key not in self._slots:
+        self._slots[key] = threading.BoundedSemaphore( self.max_per_host )
+      return self._slots[key]
+
+  def _Send( self, http_class, key, req, headers, tunnel_headers, debuglevel,
+             http_conn_args ):
+    # Requests that can't be repeated safely always go on a fresh connection:
+    # if an idle connection fails, it's unknown whether the server has got
+    # the request (e.g. a login form posted twice).
+    connection = None
+    if req.get_method() in _IDEMPOTENT_METHODS:
+      connection = self._Acquire( key )
+    if connection is not None:
+      try:
+        response = self._Request( connection, req, headers )
+        with self._lock:
+          self.connections_reused = self.connections_reused + 1
+        return connection, response
+      except ( socket.error, httplib.HTTPException ):
+        # The server has dropped the idle connection, open a fresh one.
+        connection.close()
+    connection = http_class( key[1], timeout=req.timeout, **http_conn_args )
+    if key[2]:
+      connection.set_tunnel( key[2], headers=tunnel_headers )
+    connection.set_debuglevel( debuglevel )
+    with self._lock:
+      self.connections_created = self.connections_created + 1
+    try:
+      return connection, self._Request( connection, req, headers )
+    except socket.error as e:
+      connection.close()
+      raise urllib2.URLError( e )
+    except httplib.HTTPException:
+      connection.close()
+      raise
+
+  @staticmethod
+  def _Request( connection, req, headers ):
+    connection.request( req.get_method(), req.get_selector(), req.data,
+                        headers )
+    return connection.getresponse( buffering=True )
+
+
+class _PooledResponse( io.RawIOBase ):
+  """This class wraps httplib response and hands the connection back to the
+  pool once the response body has been read completely."""
+
+  def __init__( self, pool, key, connection, response ):
+    super( _PooledResponse, self ).__init__()
+    self._pool = pool
+    self._key = key
+    self._connection = connection
+    self._response = response
+
+  def readable( self ):  # pylint: disable=invalid-name
+    return True
+
+  def readinto( self, buf ):  # pylint: disable=invalid-name
+    response = self._response
+    if response is None:
+      return 0
+    data = response.read( len( buf ) )
+    data_size = len( data )
+    buf[:data_size] = data
+    self._pool.AddBytesReceived( data_size )
+    if response.isclosed():
+      self._Finish( True )
+    elif not data_size:
+      self._Finish( response.length == 0 )
+    return data_size
+
+  def close( self ):  # pylint: disable=invalid-name
+    # The body hasn't been read completely, so the connection can't be reused.
+    if self._response is not None:
+      self._Finish( False )
+    super( _PooledResponse, self ).close()
+
+  def _Finish( self, reusable ):
+    response = self._response
+    connection = self._connection
+    self._response = None
+    self._connection = None
+    response.close()
+    self._pool.Release( self._key, connection,
+                        reusable and not response.will_close )
+
+
+class _DecodedResponse( io.RawIOBase ):
+  """This class decompresses gzip or deflate encoded response body, as it's
+  read, chunk by chunk."""
+
+  def __init__( self, raw_response, encoding ):
+    super( _DecodedResponse, self ).__init__()
+    self._raw_response = raw_response
+    self._encoding = encoding
+    self._decompressor = zlib.decompressobj( _DECODERS[encoding] )
+    self._is_first_chunk = True
+    self._is_eof = False
+    self._pending = ""
+
+  def readable( self ):  # pylint: disable=invalid-name
+    return True
+
+  def readinto( self, buf ):  # pylint: disable=invalid-name
+    while not self._pending and not self._is_eof:
+      chunk = self._raw_response.read( _DECODE_CHUNK_SIZE )
+      if chunk:
+        self._pending = self._Decompress( chunk )
+      else:
+        self._pending = self._decompressor.flush()
+        self._is_eof = True
+    data = self._pending[:len( buf )]
+    self._pending = self._pending[len( data ):]
+    buf[:len( data )] = data
+    return len( data )
+
+  def close( self ):  # pylint: disable=invalid-name
+    self._raw_response.close()
+    super( _DecodedResponse, self ).close()
+
+  def _Decompress( self, chunk ):
+    is_first_chunk = self._is_first_chunk
+    self._is_first_chunk = False
+    try:
+      return self._decompressor.decompress( chunk )
+    except zlib.error:
+      # Some servers send raw deflate stream without zlib header.
+      if not is_first_chunk or self._encoding != "deflate":
+        raise IOError( "Couldn't decode %s response." % self._encoding )
+      self._decompressor = zlib.decompressobj( -zlib.MAX_WBITS )
+      return self._decompressor.decompress( chunk )
+
+
+class KeepAliveHTTPHandler( urllib2.HTTPHandler ):
+
+  def __init__( self, pool=None, debuglevel=0 ):
+    urllib2.HTTPHandler.__init__( self, debuglevel )
+    self._pool = pool if pool is not None else GetConnectionPool()
+
+  def http_open( self, req ):
+    return self._pool.Open( httplib.HTTPConnection, req, self._debuglevel )
+
+
+class KeepAliveHTTPSHandler( urllib2.HTTPSHandler ):
+
+  def __init__( self, pool=None, debuglevel=0, context=None ):
+    urllib2.HTTPSHandler.__init__( self, debuglevel, context )
+    self._pool = pool if pool is not None else GetConnectionPool()
+
+  def https_open( self, req ):
+    return self._pool.Open( httplib.HTTPSConnection, req, self._debuglevel,
+                            context=self._context )
+
+
+def GetConnectionPool():
+  global _SHARED_POOL
+  with _SHARED_LOCK:
+    if _SHARED_POOL is None:
+      _SHARED_POOL = ConnectionPool()
+    return _SHARED_POOL
+
+
+def GetThreadBytesReceived():
+  return getattr( _THREAD_COUNTERS, "bytes_received", 0 )
+
+
+def GetSSLContext():
+  global _SHARED_SSL_CONTEXT
+  with _SHARED_LOCK:
+    if _SHARED_SSL_CONTEXT is None:
+      _SHARED_SSL_CONTEXT = ssl.SSLContext( ssl.PROTOCOL_TLSv1 )
+    return _SHARED_SSL_CONTEXT
+
+
+def BuildOpener( cookies=None, pool=None ):
+  if pool is None:
+    pool = GetConnectionPool()
+  handlers = [
+    urllib2.HTTPRedirectHandler(),
+    KeepAliveHTTPHandler( pool, debuglevel=0 ),
+    KeepAliveHTTPSHandler( pool, debuglevel=0, context=GetSSLContext() )
+  ]
+  if cookies is not None:
+    handlers.append( urllib2.HTTPCookieProcessor( cookies ) )
+  opener = urllib2.build_opener( *handlers )
+  opener.addheaders = [ ( "User-agent", _USER_AGENT ) ]
+  return opener
@@ -0,0 +1,84 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+# Missense Mutations Mapper and Randomizer for PDB files (M3R-PDB)
+# Local stand-in server for COSMIC and NCBI, to benchmark and test offline
+# ------------------------------------------------------------------------------
+import argparse
+import os
+import sys
+
+import m3r.messages as vm
+from m3r.fakeserver import FakeServer
+from m3r.fakeserver import FakeServerOptions
+
+SCRIPT_NAME = "M3R-PDB Fake Server"
+SCRIPT_VERSION = 1.0
+FIXTURES_DIRECTORY = os.path.join(
+  os.path.dirname( os.path.abspath( __file__ ) ), "fixtures" )
+
+
+def Main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument( "-f", "--fixtures", default=FIXTURES_DIRECTORY,
+                       help="fixtures directory (default is bundled one)" )
+  parser.add_argument( "--host", default="127.0.0.1",
+                       help="address to listen on (default is 127.0.0.1)" )
+  parser.add_argument( "--port", type=int, default=8080,
+                       help="port to listen on (default is 8080)" )
+  parser.add_argument( "--latency", type=float, default=0.0,
+                       help="delay of every response, in seconds" )
+  parser.add_argument( "--bandwidth", type=int, default=0,
+                       help="response bandwidth limit, in bytes per second" )
+  parser.add_argument( "--error-rate", type=float, default=0.0,
+                       help="fraction of requests that fail (0..1)" )
+  parser.add_argument( "--error-code", type=int, default=503,
+                       help="HTTP status of failed requests (default is 503)" )
+  parser.add_argument( "--seed", type=int,
+                       help="random seed of error injection" )
+  parser.add_argument( "--email", help="accepted COSMIC login (default is any)" )
+  parser.add_argument( "--password",
+                       help="accepted COSMIC password (default is any)" )
+  args = parser.parse_args()
+
+  options = FakeServerOptions( args.latency, args.bandwidth, args.error_rate,
+                               args.error_code, args.seed, args.email,
+                               args.password )
+  server = FakeServer( ( args.host, args.port ), args.fixtures, options )
+  vm.Info( "%i genes loaded from \"%s\": %s." % \
+           ( len( server.genes ), args.fixtures,
+             ", ".join( sorted( server.genes ) ) ) )
+  vm.Info( "Serving, put these lines into the settings file:" )
+  vm.Print( "cosmic:\n  url: \"%s\"\nncbi:\n  url: \"%s\"" % \
+            ( server.GetCOSMICURL(), server.GetNCBIURL() ) )
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    vm.Print( "Stopped." )
+  server.server_close()
+  return 0
+
+
+if __name__ == "__main__":
+  vm.Banner( SCRIPT_NAME, SCRIPT_VERSION )
+  SCRIPT_ERROR_CODE = 1
+  try:
+    SCRIPT_ERROR_CODE = Main()
+  except RuntimeError as e:
+    vm.Error( str( e ) )
+  sys.exit( SCRIPT_ERROR_CODE )
@@ -0,0 +1,90 @@
+﻿# -*- coding: utf-8;
+# ------------------------------------------------------------------------------
+# Copyright (C) 2019 Alexander V. Popov.
+#
+# This source code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or (at your option) any later version.
+#
+# This source code is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+# ------------------------------------------------------------------------------
+# Missense Mutations Mapper and Randomizer for PDB files (M3R-PDB)
+# M3R-PDB local databases indexer
+# ------------------------------------------------------------------------------
+import argparse
+import sys
+import time
+
+import m3r.messages as vm
+from m3r.cosmiclocal import IngestCOSMICExport
+from m3r.ncbilocal import BuildRefSeqIndex
+
+SCRIPT_NAME = "M3R-PDB Indexer"
+SCRIPT_VERSION = 1.0
+
+
+def IndexCOSMIC( args ):
+  vm.Info( "Ingesting \"%s\" into \"%s\", please wait..." % \
+           ( args.export, args.store ) )
+  row_count = IngestCOSMICExport( args.export, args.store )
+  vm.Info( "%i missense mutations stored." % row_count )
+  return 0
+
+
+def IndexRefSeq( args ):
+  record_count, protein_count = BuildRefSeqIndex( args.fasta, args.gene2refseq,
+                                                  args.taxid )
+  vm.Info( "%i FASTA records indexed, %i of them are linked to genes." % \
+           ( record_count, protein_count ) )
+  return 0
+
+
+def Main():
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers( dest="command" )
+  cosmic_parser = subparsers.add_parser(
+    "cosmic", help="build local COSMIC mutation store from the bulk export" )
+  cosmic_parser.add_argument( "-e", "--export", required=True,
+                              help="COSMIC mutant export (TSV or TSV.GZ)" )
+  cosmic_parser.add_argument( "-s", "--store", required=True,
+                              help="output mutation store (SQLite)" )
+  cosmic_parser.set_defaults( function=IndexCOSMIC )
+  refseq_parser = subparsers.add_parser(
+    "refseq", help="index local RefSeq protein FASTA for offline lookups" )
+  refseq_parser.add_argument( "-f", "--fasta", required=True,
+                              help="RefSeq protein FASTA (plain or bgzip)" )
+  refseq_parser.add_argument( "-g", "--gene2refseq", required=True,
+                              help="NCBI gene2refseq table (TSV or TSV.GZ)" )
+  refseq_parser.add_argument( "-t", "--taxid", default="9606",
+                              help="taxonomy id of the organism (default is "
+                                   "9606, human)" )
+  refseq_parser.set_defaults( function=IndexRefSeq )
+  args = parser.parse_args()
+
+  start_time = time.time()
+  try:
+    result = args.function( args )
+  except IOError as e:
+    vm.Error( "Couldn't read input file." )
+    vm.Error( "IOError: {}".format( e ) )
+    return 1
+  vm.Print( "All done: %i seconds elapsed." % ( time.time() - start_time ) )
+  return result
+
+
+if __name__ == "__main__":
+  vm.Banner( SCRIPT_NAME, SCRIPT_VERSION )
+  SCRIPT_ERROR_CODE = 1
+  try:
+    SCRIPT_ERROR_CODE = Main()
+  except RuntimeError as e:
+    vm.Error( str( e ) )
+  sys.exit( SCRIPT_ERROR_CODE )
@@ -20,27 +20,284 @@
 # ------------------------------------------------------------------------------
 import argparse
 import collections
-import copy
+import json
+import multiprocessing
 import os
 import random
+import signal
 import sys
+import threading
+import time
+
+import numpy
 
-import contrib.parse as parse
 import contrib.yaml as yaml
-from contrib.alignment.sequence import Sequence
-from contrib.alignment.vocabulary import Vocabulary
-from contrib.alignment.sequencealigner import SimpleScoring
-from contrib.alignment.sequencealigner import StrictGlobalSequenceAligner
 
+import m3r.aligners as aligners
+import m3r.hgvs as hgvs
+import m3r.mapping as mapping
 import m3r.messages as vm
+import m3r.metrics as metrics
+import m3r.outputs as outputs
+import m3r.profiling as profiling
+import m3r.sampling as sampling
 from m3r.cosmic import COSMICDatabase
+from m3r.cosmiclocal import COSMICLocalDatabase
 from m3r.ncbi import NCBIDatabase
+from m3r.ncbilocal import NCBILocalDatabase
 from m3r.pdbfile import PDBFile
+from m3r.planner import ExecutionPlanner
+from m3r.planner import LOAD_CHAIN
+from m3r.planner import ParseSize
+from m3r.tasks import RunTasks
+from m3r.tasks import Task
+from m3r.tasks import WaitAsyncResult
+from m3r.transport import GetConnectionPool
 
 SCRIPT_NAME = "M3R-PDB Tool"
 SCRIPT_VERSION = 1.0
 CONFIG_DIRECTORY = "config"
 SETTINGS_FILE = os.path.join( CONFIG_DIRECTORY, "settings.yaml" )
+SESSION_FILE = os.path.join( CONFIG_DIRECTORY, "cosmic_session.lwp" )
+DEFAULT_CHAIN = "A"
+# Manifest columns, in the order they are expected in TSV manifest without
+# a header line.
+MANIFEST_COLUMNS = ( "gene", "pdb", "chain", "nummodels" )
+# Saved models of a PDB file are recorded next to it, in this file.
+OUTPUT_MANIFEST_SUFFIX = ".outputs.tsv"
+# Worker processes are restarted after this many tasks, so that the memory
+# taken by cached PDB files and alignments stays bounded.
+MAX_TASKS_PER_WORKER = 16
+
+# Context of the worker process, see InitWorker().
+_WORKER_CONTEXT = None
+
+
+class Job( object ):
+  """This class keeps the parameters of a single mapping job: gene name, source
+  PDB file, its chain, the number of models to generate, the sampling mode and
+  seed, the shard of the sample to generate, and whether only the chain is
+  loaded, along with the job status once it has been run. Plan-only jobs keep
+  the mapping table rows instead of saving the models."""
+
+  def __init__( self, genename, pdbname, chainid=None, nummodels=0,
+                seed=None ):
+    self.genename = genename.upper()
+    self.pdbname = pdbname
+    if not self.pdbname.endswith( ".pdb" ):
+      self.pdbname += ".pdb"
+    self.chainid = chainid.upper() if chainid else DEFAULT_CHAIN
+    self.nummodels = nummodels
+    self.seed = seed
+    self.resume = False
+    self.sampling = sampling.SAMPLING_UNIFORM
+    self.tissue = None
+    self.shard = None
+    self.chain_only = False
+    self.plan_only = False
+    self.plan_rows = None
+    self.status = None
+    self.num_saved = 0
+
+  def GetName( self ):
+    return "%s %s:%s" % ( self.genename, self.pdbname, self.chainid )
+
+  def GetLoadedChain( self ):
+    # Chain to load from the PDB file, None to load all of them.
+    return self.chainid if self.chain_only else None
+
+
+class JobContext( object ):
+  """This class keeps the resources shared by all the jobs of a run: database
+  sessions (with their connection pools), fetched mutations and ref. sequences,
+  loaded PDB files and sequence alignments. Each of them is fetched, loaded or
+  computed once per run. Process pool is started, once the inputs are known,
+  to run the jobs or to save the mutants, and plan writer, if set, receives the
+  mapping tables of plan-only jobs. Time and counters of every pipeline stage
+  (and memory, if it's tracked) are collected into the metrics. Execution
+  planner picks the number of workers (up to the maximum, if set), and, by the
+  memory budget of the process, how PDB files are loaded and how sequences
+  are aligned."""
+
+  def __init__( self, settings, plan_writer=None, track_memory=False,
+                planner=None, max_workers=None, process_budget=None ):
+    self.settings = settings
+    self.pool = None
+    self.num_workers = 1
+    self.max_workers = max_workers
+    self.plan_writer = plan_writer
+    self.planner = planner if planner is not None else ExecutionPlanner()
+    self.process_budget = process_budget if process_budget is not None \
+                          else self.planner.memory_budget
+    self.track_memory = track_memory
+    self.metrics = metrics.Metrics( track_memory )
+    self._is_planned = False
+    self._cosmic_database = None
+    self._cosmic_error = None
+    self._ncbi_database = None
+    self._mutations = {}
+    self._fastas = {}
+    self._pdbfiles = {}
+    self._alignments = {}
+    self._jobs_left = collections.Counter()
+    self._cosmic_lock = threading.Lock()
+    self._ncbi_lock = threading.Lock()
+
+  def StartPool( self, num_tasks, pdbnames, ref_lengths=None ):
+    # Number of workers is planned once per run, by the number of tasks to
+    # spread between them, PDB files and lengths of the ref. sequences they
+    # align, if they do. Returns None, if there is no pool.
+    if self._is_planned or self.max_workers == 1:
+      return self.pool
+    self._is_planned = True
+    num_workers = self.planner.PlanWorkers( num_tasks, pdbnames,
+                                            self.max_workers, ref_lengths )
+    self.process_budget = self.planner.GetProcessBudget( num_workers )
+    vm.Info( "Execution plan: %s." % \
+             self.planner.GetDescription( num_workers ) )
+    if self.max_workers is not None and \
+       num_workers < min( self.max_workers, num_tasks ):
+      vm.Warn( "Running %i worker processes instead of %i, to fit into " \
+               "memory budget." % ( num_workers, self.max_workers ) )
+    if num_workers > 1:
+      vm.Info( "Starting %i worker processes..." % num_workers )
+      self.pool = multiprocessing.Pool(
+        num_workers, InitWorker, ( self.track_memory, self.process_budget ),
+        maxtasksperchild=MAX_TASKS_PER_WORKER )
+      self.num_workers = num_workers
+    return self.pool
+
+  def StopPool( self ):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool.join()
+      self.pool = None
+      self.num_workers = 1
+
+  def GetCOSMICDatabase( self ):
+    with self._cosmic_lock:
+      # Don't retry failed login for every job of the run.
+      if self._cosmic_error is not None:
+        raise RuntimeError( self._cosmic_error )
+      if self._cosmic_database is None:
+        try:
+          with self.metrics.Measure( "login" ):
+            self._cosmic_database = OpenCOSMICDatabase( self.settings )
+        except RuntimeError as e:
+          self._cosmic_error = str( e )
+          raise
+      return self._cosmic_database
+
+  def GetNCBIDatabase( self ):
+    with self._ncbi_lock:
+      if self._ncbi_database is None:
+        self._ncbi_database = OpenNCBIDatabase( self.settings )
+      return self._ncbi_database
+
+  def GetMutations( self, genename ):
+    if genename in self._mutations:
+      self.metrics.AddCacheHits( "cosmic_fetch" )
+    else:
+      cosmic_database = self.GetCOSMICDatabase()
+      with self.metrics.Measure( "cosmic_fetch" ) as stage:
+        self._mutations[genename] = FetchCOSMICMutations( cosmic_database,
+                                                          genename )
+        stage.items = len( self._mutations[genename] )
+    return self._mutations[genename]
+
+  def GetFASTAs( self, genename ):
+    if genename in self._fastas:
+      self.metrics.AddCacheHits( "ncbi_fetch" )
+    else:
+      ncbi_database = self.GetNCBIDatabase()
+      with self.metrics.Measure( "ncbi_fetch" ) as stage:
+        self._fastas[genename] = FetchNCBISequences( ncbi_database, genename )
+        stage.items = len( self._fastas[genename] )
+    return self._fastas[genename]
+
+  def PrefetchFASTAs( self, genenames ):
+    # Look up ref. sequences of all the genes with a few batched requests,
+    # instead of three requests per gene.
+    genenames = sorted( set( genenames ) - set( self._fastas ) )
+    if not genenames:
+      return
+    vm.Info( "Getting ref. sequences for %i genes..." % len( genenames ) )
+    ncbi_database = self.GetNCBIDatabase()
+    with self.metrics.Measure( "ncbi_fetch" ) as stage:
+      gene_ids = ncbi_database.FindGeneIDs( genenames )
+      refseq_map = ncbi_database.GetRefSequencesBatch( gene_ids.values() )
+      fastas = ncbi_database.GetFASTABatch( refseq_map )
+      for genename, gene_id in gene_ids.iteritems():
+        if gene_id in fastas:
+          self._fastas[genename] = fastas[gene_id]
+          stage.items = stage.items + len( fastas[gene_id] )
+
+  def GetRefLengths( self, genenames ):
+    # Lengths of the fetched ref. sequences of the genes.
+    return [ len( fasta ) for genename in set( genenames )
+             for fasta in self._fastas.get( genename, {} ).itervalues() ]
+
+  def AddJobs( self, jobs ):
+    # Jobs of the run are counted per gene and per PDB file, to know when
+    # their data isn't needed anymore.
+    for job in jobs:
+      self._jobs_left[( "gene", job.genename )] += 1
+      self._jobs_left[( "pdb", job.pdbname )] += 1
+
+  def ReleaseJob( self, job ):
+    # Fetched data of the gene, its alignments, and the loaded PDB file are
+    # dropped once the last job of the gene, or of the file, has got them.
+    gene_key = ( "gene", job.genename )
+    self._jobs_left[gene_key] -= 1
+    if self._jobs_left[gene_key] <= 0:
+      del self._jobs_left[gene_key]
+      ref_fastas = set( self._fastas.get( job.genename, {} ).itervalues() )
+      for key in [ alignment_key for alignment_key in self._alignments
+                   if alignment_key[0] in ref_fastas ]:
+        del self._alignments[key]
+      self._mutations.pop( job.genename, None )
+      self._fastas.pop( job.genename, None )
+    pdb_key = ( "pdb", job.pdbname )
+    self._jobs_left[pdb_key] -= 1
+    if self._jobs_left[pdb_key] <= 0:
+      del self._jobs_left[pdb_key]
+      for key in [ pdbfile_key for pdbfile_key in self._pdbfiles
+                   if pdbfile_key[0] == job.pdbname ]:
+        del self._pdbfiles[key]
+
+  def GetPDBFile( self, pdbname, chainid=None ):
+    # Chain is loaded alone, if it's set. Other chains are never left out of
+    # the models implicitly, so if the planner says the whole file doesn't
+    # fit into memory, it's only warned about.
+    key = ( pdbname, chainid )
+    if key in self._pdbfiles:
+      self.metrics.AddCacheHits( "pdb_load" )
+    else:
+      if chainid is None and \
+         self.planner.PlanLoading( pdbname, self.process_budget ) == LOAD_CHAIN:
+        vm.Warn( "\"%s\" may not fit into memory budget, use --chain-only " \
+                 "to load the chain of the job only." % pdbname )
+      with self.metrics.Measure( "pdb_load" ) as stage:
+        self._pdbfiles[key] = LoadPDB( pdbname, chainid )
+        stage.items = 1
+    return self._pdbfiles[key]
+
+  def WritePlan( self, job ):
+    if self.plan_writer is not None and job.plan_rows:
+      self.plan_writer.Write( job.plan_rows )
+    job.plan_rows = None
+
+  def Align( self, ref_fasta, pdb_fasta ):
+    key = ( ref_fasta, pdb_fasta )
+    if key in self._alignments:
+      self.metrics.AddCacheHits( "align" )
+    else:
+      mode = self.planner.PlanAlignment( len( ref_fasta ), len( pdb_fasta ),
+                                         self.process_budget )
+      with self.metrics.Measure( "align" ) as stage:
+        self._alignments[key] = AlignSequences( ref_fasta, pdb_fasta, mode )
+        stage.items = len( ref_fasta ) + len( pdb_fasta )
+    return self._alignments[key]
 
 
 def LoadYAML( stream, loader=yaml.Loader ):
@@ -63,228 +320,674 @@ def LoadSettingsFromFile( settings_filename=SETTINGS_FILE ):
   return settings_data
 
 
-def BuildEstimatedFASTA( fasta_size, mutation_list ):
-  fasta = list( "-" * fasta_size )
-  for mut in mutation_list:
-    mut_info = parse.parse( "p.{}{:d}{}", mut )
-    fasta[mut_info[1]-1] = mut_info[0]
-  return "".join( fasta ).rstrip( "-" )
-
-
-def CompareFASTA( ref_fasta, estimated_fasta ):
-  ref_fasta_size = len( ref_fasta )
-  estimated_fasta_size = len( estimated_fasta )
-  if ref_fasta_size < estimated_fasta_size:
-    return False
-  for idx in range( estimated_fasta_size ):
-    if estimated_fasta[idx] == "-":
+def ReadManifestTSV( stream ):
+  columns = MANIFEST_COLUMNS
+  rows = []
+  for line in stream:
+    line = line.strip()
+    if not line or line.startswith( "#" ):
       continue
-    if ref_fasta[idx] != estimated_fasta[idx]:
-      return False
-  return True
-
+    fields = [ field.strip() for field in line.split( "\t" ) ]
+    if not rows and fields[0].lower() == columns[0]:
+      columns = tuple( field.lower() for field in fields )
+      continue
+    rows.append( dict( zip( columns, fields ) ) )
+  return rows
 
-def Main():
-  vm.Info( "Initializing..." )
-  genename = None
-  pdbname = None
-  chainid = "A"
-  nummodels = 0
 
-  parser = argparse.ArgumentParser()
-  parser.add_argument( "-g", "--gene", help="gene name to lookup" )
-  parser.add_argument( "-p", "--pdb", help="source PDB file" )
-  parser.add_argument( "-c", "--chain",
-                       help="PDB file chain of the protein (default is A)" )
-  parser.add_argument( "-n", "--nummodels",
-                       help="maximum number of models to generate" )
-  args = parser.parse_args()
+def LoadManifest( manifest_filename, chainid=None, nummodels=0 ):
+  # Manifest is either TSV file with gene, pdb, chain and nummodels columns,
+  # or YAML list of mappings with the same keys. Chain and number of models
+  # default to the command-line options.
+  vm.Info( "Loading \"%s\"..." % manifest_filename )
+  rows = None
+  with open( manifest_filename ) as stream:
+    if manifest_filename.lower().endswith( ( ".yaml", ".yml" ) ):
+      rows = LoadYAML( stream )
+      if isinstance( rows, dict ):
+        rows = rows.get( "jobs" )
+    else:
+      rows = ReadManifestTSV( stream )
+  if not rows or not isinstance( rows, list ):
+    raise RuntimeError( "%s: no jobs found." % manifest_filename )
+  jobs = []
+  for job_index, row in enumerate( rows, 1 ):
+    if not isinstance( row, dict ) or not row.get( "gene" ) or \
+       not row.get( "pdb" ):
+      raise RuntimeError( "%s: job %i has no gene or PDB file set." % \
+                          ( manifest_filename, job_index ) )
+    try:
+      job_nummodels = int( row.get( "nummodels" ) or nummodels )
+    except ValueError:
+      job_nummodels = 0
+    if job_nummodels <= 0:
+      raise RuntimeError( "%s: job %i has no valid number of models set." % \
+                          ( manifest_filename, job_index ) )
+    jobs.append( Job( str( row["gene"] ), str( row["pdb"] ),
+                      str( row.get( "chain" ) or chainid or "" ),
+                      job_nummodels ) )
+  return jobs
 
-  # Possible gene names: OGG1, UNG, etc.
-  genename = args.gene.upper()
-  if not genename:
-    vm.Error( "Gene name not set, use --gene as a command-line option" )
-    return 1
-  pdbname = args.pdb
-  if not pdbname:
-    vm.Error( "Source PDB name not set, use --pdb as a command-line option" )
-    return 1
-  try:
-    nummodels = int( args.nummodels )
-  except TypeError:
-    nummodels = 0
-  if not nummodels:
-    vm.Error( "Number of output models not set, use --nummodels as a " \
-              "command-line option" )
-    return 1
-  if args.chain:
-    chainid = args.chain.upper()
 
-  settings = None
+def OpenCOSMICDatabase( settings ):
+  cosmic_settings = None
   try:
-    settings = LoadSettingsFromFile()
-  except IOError as e:
-    vm.Error( "Couldn't read settings file." )
-    vm.Error( "IOError: {}".format( e ) )
-    return 1
+    cosmic_settings = settings["cosmic"]
+  except ( TypeError, KeyError ):
+    pass
+  if cosmic_settings and cosmic_settings.get( "local_store" ):
+    local_store = cosmic_settings["local_store"]
+    vm.Info( "Using local COSMIC mutation store \"%s\"." % local_store )
+    return COSMICLocalDatabase( local_store )
 
   vm.Info( "Logging in to COSMIC database, please wait..." )
   cosmic_login = None
   cosmic_password = None
   try:
-    cosmic_settings = settings["cosmic"]
     cosmic_login = cosmic_settings["email"]
     cosmic_password = cosmic_settings["password"]
   except ( TypeError, KeyError ):
     vm.Error( "No COSMIC login information present in settings file." )
-  cosmic_database = COSMICDatabase()
+  session_file = SESSION_FILE
+  cosmic_url = None
+  if cosmic_settings:
+    session_file = cosmic_settings.get( "session_file", SESSION_FILE )
+    cosmic_url = cosmic_settings.get( "url" ) or None
+  cosmic_database = COSMICDatabase( session_file, cosmic_url )
   cosmic_database.Login( cosmic_login, cosmic_password )
   cosmic_login = None
   cosmic_password = None
   vm.Info( "Login successful." )
+  return cosmic_database
+
 
+def FetchCOSMICMutations( cosmic_database, genename ):
   # Connect to COSMIC database and get the list of missence mutations for the
   # gene.
   vm.Info( "Getting info for %s..." % genename )
   geneid = cosmic_database.FindGeneID( genename )
   vm.Info( "COSMIC %s gene ID = '%i'." % ( genename, geneid ) )
   vm.Info( "Getting missense mutations for %s..." % genename )
-  mutations = cosmic_database.GetMissenseMutations( geneid )
+  return cosmic_database.GetMissenseMutations( geneid )
 
+
+def OpenNCBIDatabase( settings ):
+  ncbi_api_key = None
+  ncbi_email = None
+  ncbi_url = None
+  ncbi_settings = settings.get( "ncbi" ) if settings else None
+  if ncbi_settings:
+    if ncbi_settings.get( "local_fasta" ):
+      local_fasta = ncbi_settings["local_fasta"]
+      vm.Info( "Using local RefSeq FASTA \"%s\"." % local_fasta )
+      return NCBILocalDatabase( local_fasta )
+    ncbi_api_key = ncbi_settings.get( "api_key" ) or None
+    ncbi_email = ncbi_settings.get( "email" ) or None
+    ncbi_url = ncbi_settings.get( "url" ) or None
+  return NCBIDatabase( ncbi_api_key, ncbi_email, url=ncbi_url )
+
+
+def FetchNCBISequences( ncbi_database, genename ):
   # Connect to NCBI database and get ref. sequences for the gene, along with
   # their FASTA sequences.
-  ncbi_database = NCBIDatabase()
   geneid = ncbi_database.FindGeneID( genename )
   vm.Info( "NCBI %s gene ID = '%i'." % ( genename, geneid ) )
   refseq = ncbi_database.GetRefSequences( geneid )
   fastas = ncbi_database.GetFASTA( refseq )
   vm.Info( "%i FASTA sequences fetched." % len( fastas ) )
+  return fastas
+
+
+def LoadPDB( pdbname, chainid=None ):
+  if chainid is None:
+    vm.Info( "Loading \"%s\"..." % pdbname )
+  else:
+    vm.Info( "Loading chain %s of \"%s\" only, the models will have no " \
+             "other chains." % ( chainid, pdbname ) )
+  return PDBFile( pdbname, chainid )
+
+
+def AlignSequences( ref_fasta, pdb_fasta, mode=aligners.ALIGN_FULL ):
+  # Align ref. sequence and the sequence loaded from PDB, returns alignment
+  # score and the aligned PDB sequence.
+  vm.Info( "Aligning sequences (%s, %i x %i), please wait..." % \
+           ( mode, len( ref_fasta ), len( pdb_fasta ) ) )
+  if not ref_fasta or not pdb_fasta:
+    return 0, None
+  return aligners.Align( ref_fasta, pdb_fasta, mode )
+
+
+def RunStages( tasks ):
+  failed_tasks = RunTasks( tasks )
+  for task in failed_tasks:
+    vm.Error( "%s stage failed." % task.name )
+    vm.Error( "{}: {}".format( type( task.error ).__name__, task.error ) )
+  if failed_tasks:
+    return None
+  return [ task.result for task in tasks ]
+
 
-  # Build estimated FASTA sequence to compare with ref. sequences, to find which
-  # ref. sequence our mutations are mapped onto.
-  max_fasta_size = 0
-  for _, fasta in fastas.iteritems():
-    fasta_size = len( fasta )
-    if fasta_size > max_fasta_size:
-      max_fasta_size = fasta_size
-  estimated_fasta = BuildEstimatedFASTA( max_fasta_size, \
-                                         mutations["AA Mutation"] )
-  matching_fasta_name = None
-  for key, value in fastas.iteritems():
-    if CompareFASTA( value, estimated_fasta ):
-      matching_fasta_name = key
-      break
+def FetchJobData( context, job ):
+  # Fetch COSMIC and NCBI data concurrently, returns None if any of them has
+  # failed.
+  return RunStages( [
+    Task( "COSMIC", context.GetMutations, job.genename ),
+    Task( "NCBI", context.GetFASTAs, job.genename )
+  ] )
+
+
+def RunJob( context, job ):
+  # Load the PDB file and fetch COSMIC and NCBI data concurrently, these are
+  # independent until ref. sequence matching.
+  results = RunStages( [
+    Task( "COSMIC", context.GetMutations, job.genename ),
+    Task( "NCBI", context.GetFASTAs, job.genename ),
+    Task( "PDB", context.GetPDBFile, job.pdbname, job.GetLoadedChain() )
+  ] )
+  if results is None:
+    return 1
+  mutations, fastas, pdbfile = results
+  error_code = ProcessJob( context, job, mutations, fastas, pdbfile )
+  context.WritePlan( job )
+  return error_code
+
+
+def ProcessJob( context, job, mutations, fastas, pdbfile ):
+  genename = job.genename
+  chainid = job.chainid
+  nummodels = job.nummodels
+
+  # Find which ref. sequence our mutations are mapped onto, by the share of
+  # COSMIC reference AAs each of them agrees with.
+  with context.metrics.Measure( "isoform_match" ) as stage:
+    changes = hgvs.ParseMutationColumn( mutations["AA Mutation"] )
+    isoform_matches = mapping.MatchIsoforms( changes, fastas )
+    stage.items = len( changes )
+  for name, fraction in isoform_matches:
+    vm.Info( "%5.1f%% of COSMIC sites match \"%s\"." % \
+             ( fraction * 100.0, name ) )
+  matching_fasta_name = mapping.SelectIsoform( isoform_matches )
   if not matching_fasta_name:
     vm.Error( "No matching ref. sequences found for %s." % genename )
     return 1
   vm.Info( "COSMIC mutations are mapped onto %s ref. sequence \"%s\"." % \
            ( genename, matching_fasta_name ) )
 
-  # Load the PDB file.
-  if not pdbname.endswith( ".pdb" ):
-    pdbname += ".pdb"
-  vm.Info( "Loading \"%s\"..." % pdbname )
-  try:
-    pdbfile = PDBFile( pdbname )
-  except IOError as e:
-    vm.Error( "Couldn't load PDB file." )
-    vm.Error( "IOError: {}".format( e ) )
-    return 1
   pdb_fasta = pdbfile.GetFASTA( chainid )
 
   # Align our estimated sequence and the sequence loaded from PDB.
-  vm.Info( "Aligning sequences, please wait..." )
-  vocab = Vocabulary()
-  ref_encoded = vocab.encodeSequence( Sequence( fastas[matching_fasta_name] ) )
-  pdb_encoded = vocab.encodeSequence( Sequence( pdb_fasta ) )
-  aligner = StrictGlobalSequenceAligner( SimpleScoring( 2, -1 ), -2 )
-  score, encodeds = aligner.align( ref_encoded, pdb_encoded, backtrace=True )
-  if len( encodeds ) < 1:
+  score, aligned_fasta = context.Align( fastas[matching_fasta_name],
+                                        pdb_fasta )
+  if aligned_fasta is None:
     vm.Error( "Sequence alignment failed." )
     return 1
   vm.Info( "Sequence alignment succeeded (score = %.2f)." % score )
-  aligned_fasta = "".join( str( letter ) for letter in \
-                           vocab.decodeSequence( encodeds[0].second ).elements )
-
-  # Generate PDB residue numbers mapped to aligned FASTA.
-  pdb_resid_map = []
-  pdb_position = 0
-  pdb_fasta_len = len( pdb_fasta )
-  for letter in aligned_fasta:
-    if pdb_position >= pdb_fasta_len:
-      pdb_resid_map.append( 0 )
-      continue
-    if letter == "-":
-      pdb_resid_map.append( 0 )
-      if pdb_fasta[pdb_position] == "-":
-        pdb_position = pdb_position + 1
-      continue
-    if pdb_fasta[pdb_position] == "-":
-      pdb_resid_map.append( 0 )
-    else:
-      pdb_resid_map.append( pdb_position + 1 )
-    pdb_position = pdb_position + 1
-
-  # Build a list of mutations that can be mapped onto our aligned sequence.
-  pdb_mutation_info = {}
-  mutation_counter = 0
-  for mut in mutations["AA Mutation"]:
-    mut_source, mut_number, mut_target = parse.parse( "p.{}{:d}{}", mut )
-    if aligned_fasta[mut_number-1] != mut_source:
-      continue
-    mut_name = mut_source + str( mut_number ) + mut_target
-    mut_dict_index = "{:08d}{}".format( mut_number, mut_target )
-    if mut_dict_index in pdb_mutation_info:
-      # vm.Warn( "Skipping duplicate mutation info for '%s'." % mut_name )
-      continue
-    if not pdb_resid_map[mut_number-1]:
-      vm.Warn( "Skipping mutation of missing residue '%s'." % mut_name )
-      continue
-    pdb_mutation_info[mut_dict_index] = {
-      "name" : mut_name,
-      "resid" : pdb_resid_map[mut_number-1],
-      "from" : mut_source,
-      "to" : mut_target,
-      "status" : mutations["Somatic Status"][mutation_counter],
-      "transcript" : mutations["Transcript"][mutation_counter],
-      "zygosity" : mutations["Zygosity"][mutation_counter],
-      "tissue" : mutations["Primary Tissue"][mutation_counter],
-      "histology" : mutations["Histology"][mutation_counter]
-    }
-    mutation_counter = mutation_counter + 1
-  pdb_mutation_info = collections.OrderedDict( \
-      sorted( pdb_mutation_info.iteritems() ) ).values()
-  num_pdb_mutations = len( pdb_mutation_info )
+
+  # Generate PDB residue numbers mapped to aligned FASTA, and project the
+  # mutations onto them.
+  with context.metrics.Measure( "map" ) as stage:
+    resid_map = mapping.BuildResidueMap( aligned_fasta, pdb_fasta )
+    pdb_mutations = mapping.ProjectMutations( changes, aligned_fasta,
+                                              resid_map )
+    stage.items = len( pdb_mutations )
+  for index in numpy.flatnonzero( pdb_mutations.resids == 0 ):
+    vm.Warn( "Skipping mutation of missing residue '%s'." % \
+             pdb_mutations.GetName( index ) )
+  pdb_mutations = pdb_mutations.Take(
+    numpy.flatnonzero( pdb_mutations.resids ) )
+  num_pdb_mutations = len( pdb_mutations )
   vm.Info( "%i mutations can be applied to the PDB file." % num_pdb_mutations )
 
   # Save PDB files with mutations.
   # Pick N randomly selected, if too many.
-  mutation_index_list = list( range( 0, num_pdb_mutations ) )
+  # Resumed run reuses the seed of the previous run, unless the seed is set,
+  # so that interrupted run goes on with the same sample.
+  output_manifest = outputs.OutputManifest(
+    GetOutputManifestPath( job.pdbname ) ).Load()
+  if job.seed is None and job.resume:
+    job.seed = output_manifest.GetSeed( genename, chainid )
+    if job.seed is not None:
+      vm.Info( "Resuming the previous run, seed = %i is taken from %s." % \
+              ( job.seed, output_manifest.path ) )
+    else:
+      vm.Info( "Nothing to resume, no seed is recorded in %s." % \
+               output_manifest.path )
+  if job.seed is None:
+    job.seed = random.randint( 0, 2 ** 31 - 1 )
+  recurrences = mapping.CountMutationRows( changes, pdb_mutations )
+  weights = None
+  if job.sampling == sampling.SAMPLING_RECURRENCE:
+    weights = recurrences.tolist()
+  elif job.sampling == sampling.SAMPLING_TISSUE:
+    tissue_mask = mapping.GetTissueMask( mutations["Primary Tissue"],
+                                         job.tissue )
+    weights = mapping.CountMutationRows( changes, pdb_mutations,
+                                         tissue_mask ).tolist()
+    vm.Info( "%i mutations are found in %s tissue." % \
+             ( numpy.count_nonzero( weights ), job.tissue ) )
   if num_pdb_mutations > nummodels:
-    vm.Info( "Randomly picking %i mutations out of %i." % \
-            ( nummodels, num_pdb_mutations ) )
-    random.shuffle( mutation_index_list )
-    mutation_index_list = mutation_index_list[:nummodels]
-    mutation_index_list.sort()
+    vm.Info( "Randomly picking %i mutations out of %i (%s, seed = %i)." % \
+            ( nummodels, num_pdb_mutations, job.sampling, job.seed ) )
+  mutation_index_list = sampling.SampleIndices( num_pdb_mutations, nummodels,
+                                                job.seed, weights )
+  if job.shard is not None:
+    # Every shard takes each N-th model of the same sample, so the shards are
+    # disjoint, and all together they make the whole sample.
+    shard_index, shard_count = job.shard
+    mutation_index_list = mutation_index_list[shard_index::shard_count]
+    vm.Info( "Shard %i/%i: %i mutations of the sample." % \
+             ( shard_index, shard_count, len( mutation_index_list ) ) )
+  if job.plan_only:
+    job.plan_rows = mapping.BuildPlanRows(
+      genename, job.pdbname, chainid, matching_fasta_name, pdb_mutations,
+      mutations, recurrences, mutation_index_list )
+    vm.Info( "%i mutations planned." % len( job.plan_rows ) )
+    return 0
+  mutation_list = []
+  params = GetOutputParams( job )
+  for index in mutation_index_list:
+    mut = pdb_mutations.GetMutationInfo( index, mutations )
+    if output_manifest.IsSaved( GetOutputName( job.pdbname, mut ), params ):
+      job.num_saved = job.num_saved + 1
+    else:
+      mutation_list.append( mut )
+  if job.num_saved:
+    vm.Info( "%i models are already saved, skipping them." % job.num_saved )
+    context.metrics.AddCacheHits( "write", job.num_saved )
+  # Workers are started once the number of the mutants to save is known.
+  if len( mutation_list ) > 1 and \
+     context.StartPool( len( mutation_list ), [ job.pdbname ] ) is not None:
+    vm.Info( "Saving %i models with %i worker processes." % \
+             ( len( mutation_list ),
+               min( len( mutation_list ), context.num_workers ) ) )
+    job.num_saved = job.num_saved + SaveMutantsInPool(
+      context, job, mutation_list )
+  else:
+    with context.metrics.Measure( "write" ) as stage:
+      stage.items = SaveMutants( pdbfile, job, mutation_list )
+    job.num_saved = job.num_saved + stage.items
+  return 0
+
+
+def GetOutputManifestPath( pdbname ):
+  return os.path.splitext( pdbname )[0] + OUTPUT_MANIFEST_SUFFIX
+
+
+def GetOutputName( pdbname, mut ):
   filename, fileext = os.path.splitext( pdbname )
+  return filename + "." + mut["name"].lower() + fileext
+
+
+def GetOutputParams( job ):
+  # Parameters the saved models depend on, a model saved with different ones
+  # is generated again.
+  return {
+    "gene" : job.genename,
+    "chain" : job.chainid,
+    "nummodels" : job.nummodels,
+    "seed" : job.seed,
+    "sampling" : job.sampling,
+    "tissue" : job.tissue
+  }
+
+
+def SaveMutants( pdbfile, job, mutation_list ):
+  output_manifest = outputs.OutputManifest(
+    GetOutputManifestPath( job.pdbname ) )
+  params = GetOutputParams( job )
   progname = SCRIPT_NAME + " " + str( SCRIPT_VERSION )
-  for index in mutation_index_list:
-    mut = pdb_mutation_info[index]
-    output_name = filename + "." + mut["name"].lower() + fileext
+  for mut in mutation_list:
+    output_name = GetOutputName( job.pdbname, mut )
     vm.Info( "Saving: %s" % output_name )
-    pdbfile_mutated = copy.deepcopy( pdbfile )
-    pdbfile_mutated.MutateAA( chainid, mut )
-    pdbfile_mutated.Save( output_name, progname )
+    pdbfile_mutated = pdbfile.Copy()
+    pdbfile_mutated.MutateAA( job.chainid, mut )
+    # Save to a temporary file first, so that an interrupted run never leaves
+    # a partial model behind.
+    temp_name = output_name + ".part"
+    pdbfile_mutated.Save( temp_name, progname )
+    sha1 = outputs.HashFile( temp_name )
+    outputs.ReplaceFile( temp_name, output_name )
+    output_manifest.Add( mut["name"], output_name, sha1, params )
+  return len( mutation_list )
+
+
+def SaveMutantsInPool( context, job, mutation_list ):
+  # Split the mutants between the workers, each of them loads the PDB file
+  # once and saves its share. Metrics of the workers are added up, so their
+  # time is the total time spent by all of them.
+  num_chunks = min( len( mutation_list ), context.num_workers )
+  chunks = [ ( job, mutation_list[index::num_chunks] )
+             for index in range( num_chunks ) ]
+  num_saved = 0
+  for chunk_num_saved, worker_metrics in WaitAsyncResult(
+      context.pool.map_async( SaveMutantsWorker, chunks ) ):
+    num_saved = num_saved + chunk_num_saved
+    context.metrics.Merge( worker_metrics )
+  return num_saved
+
+
+def InitWorker( track_memory=False, process_budget=None ):
+  global _WORKER_CONTEXT
+  # Ctrl+C is handled by the main process, which terminates the pool. Workers
+  # are forked with the same random state, so it's reseeded. Worker plans
+  # within its share of the memory budget, and doesn't start a pool of its own.
+  signal.signal( signal.SIGINT, signal.SIG_IGN )
+  random.seed()
+  _WORKER_CONTEXT = JobContext( None, track_memory=track_memory,
+                                max_workers=1, process_budget=process_budget )
+
+
+def SaveMutantsWorker( chunk ):
+  # Worker metrics are collected per task, and returned with its result.
+  job, mutation_list = chunk
+  _WORKER_CONTEXT.metrics.Reset()
+  pdbfile = _WORKER_CONTEXT.GetPDBFile( job.pdbname, job.GetLoadedChain() )
+  with _WORKER_CONTEXT.metrics.Measure( "write" ) as stage:
+    stage.items = SaveMutants( pdbfile, job, mutation_list )
+  return stage.items, _WORKER_CONTEXT.metrics.ToDict()
+
+
+def ProcessJobWorker( job, mutations, fastas ):
+  # Workers don't access the network, COSMIC and NCBI data are fetched by the
+  # main process and passed along with the job.
+  _WORKER_CONTEXT.metrics.Reset()
+  try:
+    pdbfile = _WORKER_CONTEXT.GetPDBFile( job.pdbname,
+                                          job.GetLoadedChain() )
+    error_code = ProcessJob( _WORKER_CONTEXT, job, mutations, fastas, pdbfile )
+  except Exception as e:  # pylint: disable=broad-except
+    vm.Error( "%s: %s: %s" % ( job.GetName(), type( e ).__name__, e ) )
+    error_code = 1
+  return error_code, job.num_saved, job.plan_rows, \
+         _WORKER_CONTEXT.metrics.ToDict()
+
+
+def RunJobs( context, jobs ):
+  # Run the jobs one after another, a failed job doesn't stop the run. Data
+  # of a gene or a PDB file is dropped after its last job, so memory doesn't
+  # grow with the manifest.
+  context.AddJobs( jobs )
+  for job_index, job in enumerate( jobs, 1 ):
+    vm.Info( "Job %i of %i: %s." % ( job_index, len( jobs ), job.GetName() ) )
+    try:
+      error_code = RunJob( context, job )
+    except Exception as e:  # pylint: disable=broad-except
+      vm.Error( "{}: {}".format( type( e ).__name__, e ) )
+      error_code = 1
+    context.ReleaseJob( job )
+    job.status = "OK" if error_code == 0 else "FAILED"
+
+
+def RunJobsInPool( context, jobs, pool ):
+  # The main process fetches data of the jobs one by one, and hands the jobs
+  # over to the pool, so that all the network requests go through its shared
+  # sessions and rate limiters. Workers process the jobs meanwhile. There is
+  # at most one job per worker in flight, and the data of a gene is dropped
+  # after its last job, so memory doesn't grow with the manifest.
+  context.AddJobs( jobs )
+  pending_jobs = collections.deque()
+  for job_index, job in enumerate( jobs, 1 ):
+    vm.Info( "Job %i of %i: %s." % ( job_index, len( jobs ), job.GetName() ) )
+    results = None
+    try:
+      results = FetchJobData( context, job )
+    except Exception as e:  # pylint: disable=broad-except
+      vm.Error( "{}: {}".format( type( e ).__name__, e ) )
+    context.ReleaseJob( job )
+    if results is None:
+      job.status = "FAILED"
+      continue
+    while len( pending_jobs ) >= context.num_workers:
+      FinishPoolJob( context, *pending_jobs.popleft() )
+    mutations, fastas = results
+    pending_jobs.append( ( job, pool.apply_async(
+      ProcessJobWorker, ( job, mutations, fastas ) ) ) )
+  while pending_jobs:
+    FinishPoolJob( context, *pending_jobs.popleft() )
+
+
+def FinishPoolJob( context, job, result ):
+  error_code, job.num_saved, job.plan_rows, worker_metrics = \
+    WaitAsyncResult( result )
+  context.metrics.Merge( worker_metrics )
+  context.WritePlan( job )
+  job.status = "OK" if error_code == 0 else "FAILED"
 
-  vm.Print( "All done." )
+
+def RunBatch( context, jobs ):
+  try:
+    context.PrefetchFASTAs( job.genename for job in jobs )
+  except Exception as e:  # pylint: disable=broad-except
+    vm.Warn( "Batched ref. sequence lookup failed, genes will be looked up " \
+             "one by one." )
+    vm.Warn( "{}: {}".format( type( e ).__name__, e ) )
+
+  # Workers run the whole jobs, so they align the ref. sequences.
+  pool = context.StartPool(
+    len( jobs ), [ job.pdbname for job in jobs ],
+    context.GetRefLengths( job.genename for job in jobs ) )
+  if pool is not None:
+    RunJobsInPool( context, jobs, pool )
+  else:
+    RunJobs( context, jobs )
+
+  vm.Print( vm.HR_LINE )
+  for job in jobs:
+    vm.Print( "{:<48} {:<6} {:>6}".format( job.GetName(), job.status,
+                                           job.num_saved ) )
+  vm.Print( vm.HR_LINE )
+  num_failed = len( [ job for job in jobs if job.status != "OK" ] )
+  if num_failed:
+    vm.Error( "%i of %i jobs failed." % ( num_failed, len( jobs ) ) )
+    return 1
   return 0
 
 
+def SaveMetrics( metrics_filename, run_metrics, jobs, wall_time ):
+  # Metrics are saved as a single JSON document, for monitoring to pick up.
+  report = collections.OrderedDict()
+  report["wall_time"] = wall_time
+  report["stages"] = run_metrics.ToDict()
+  report["jobs"] = [ collections.OrderedDict( [
+    ( "gene", job.genename ),
+    ( "pdb", job.pdbname ),
+    ( "chain", job.chainid ),
+    ( "status", job.status ),
+    ( "num_saved", job.num_saved )
+  ] ) for job in jobs ]
+  with open( metrics_filename, "w" ) as stream:
+    json.dump( report, stream, indent=2 )
+    stream.write( "\n" )
+
+
+def Main():
+  vm.Info( "Initializing..." )
+  nummodels = 0
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument( "-g", "--gene", help="gene name to lookup" )
+  parser.add_argument( "-p", "--pdb", help="source PDB file" )
+  parser.add_argument( "-c", "--chain",
+                       help="PDB file chain of the protein (default is A)" )
+  parser.add_argument( "-n", "--nummodels",
+                       help="maximum number of models to generate" )
+  parser.add_argument( "-m", "--manifest",
+                       help="TSV or YAML file with the list of jobs (gene, " \
+                            "pdb, chain, nummodels) to run in one process" )
+  parser.add_argument( "-j", "--jobs", type=int,
+                       help="number of worker processes (default is the " \
+                            "CPU budget); manifest jobs, or the models of " \
+                            "a single job, are spread between them" )
+  parser.add_argument( "--cpu-budget", type=int, default=1,
+                       help="number of CPUs the run may take (default is " \
+                            "1), the planner picks the number of worker " \
+                            "processes up to it" )
+  parser.add_argument( "--memory-budget", metavar="SIZE",
+                       help="memory the run may take, e.g. 4G; the planner " \
+                            "picks the number of worker processes and " \
+                            "alignment algorithm to fit it, and warns about " \
+                            "PDB files that don't" )
+  parser.add_argument( "--chain-only", action="store_true",
+                       help="load only the chain of the job from the PDB " \
+                            "file, to save memory; the models will have no " \
+                            "other chains" )
+  parser.add_argument( "-s", "--seed", type=int,
+                       help="seed of the random mutation sampling, makes " \
+                            "the sample reproducible (default is a new " \
+                            "random seed, or the recorded one with --resume)" )
+  parser.add_argument( "--resume", action="store_true",
+                       help="resume the previous run: reuse the seed " \
+                            "recorded in the output manifest of the PDB " \
+                            "file for the gene and chain, unless --seed is " \
+                            "set, and skip the models already saved" )
+  parser.add_argument( "--sampling", choices=sampling.SAMPLING_MODES,
+                       default=sampling.SAMPLING_UNIFORM,
+                       help="how to pick the mutations, if there are too " \
+                            "many: uniformly (default), weighted by COSMIC " \
+                            "recurrence, or by recurrence in --tissue" )
+  parser.add_argument( "--tissue",
+                       help="COSMIC primary tissue for \"tissue\" sampling, " \
+                            "e.g. lung" )
+  parser.add_argument( "--shard", metavar="I/N",
+                       help="generate only the I-th of N disjoint shards of " \
+                            "the sample (0 <= I < N), requires --seed" )
+  parser.add_argument( "--plan", metavar="FILE",
+                       help="don't save the models, write the mutation " \
+                            "mapping table to FILE instead (TSV, or JSON " \
+                            "Lines if FILE ends with .jsonl)" )
+  parser.add_argument( "--metrics", metavar="FILE",
+                       help="write time and counters of the pipeline " \
+                            "stages, and the job statuses, to JSON FILE" )
+  parser.add_argument( "--track-memory", action="store_true",
+                       help="account memory allocated by the pipeline " \
+                            "stages, and report the top allocation sites" )
+  args = parser.parse_args()
+
+  try:
+    nummodels = int( args.nummodels )
+  except TypeError:
+    nummodels = 0
+  if args.jobs is not None and args.jobs < 1:
+    vm.Error( "Number of worker processes must be positive" )
+    return 1
+  if args.cpu_budget < 1:
+    vm.Error( "CPU budget must be positive" )
+    return 1
+  memory_budget = None
+  if args.memory_budget:
+    memory_budget = ParseSize( args.memory_budget )
+    if not memory_budget:
+      vm.Error( "Memory budget must be set as a size, e.g. 512M or 4G" )
+      return 1
+  if args.sampling == sampling.SAMPLING_TISSUE and not args.tissue:
+    vm.Error( "Tissue not set, use --tissue as a command-line option" )
+    return 1
+  shard = None
+  if args.shard:
+    shard = sampling.ParseShard( args.shard )
+    if shard is None:
+      vm.Error( "Shard must be set as I/N, where 0 <= I < N" )
+      return 1
+    # Independent shards must draw the very same sample.
+    if args.seed is None:
+      vm.Error( "Sharding requires the sample seed, use --seed as a " \
+                "command-line option" )
+      return 1
+  jobs = None
+  if args.manifest:
+    try:
+      jobs = LoadManifest( args.manifest, args.chain, nummodels )
+    except IOError as e:
+      vm.Error( "Couldn't read manifest file." )
+      vm.Error( "IOError: {}".format( e ) )
+      return 1
+  else:
+    # Possible gene names: OGG1, UNG, etc.
+    if not args.gene:
+      vm.Error( "Gene name not set, use --gene as a command-line option" )
+      return 1
+    if not args.pdb:
+      vm.Error( "Source PDB name not set, use --pdb as a command-line option" )
+      return 1
+    if not nummodels:
+      vm.Error( "Number of output models not set, use --nummodels as a " \
+                "command-line option" )
+      return 1
+    jobs = [ Job( args.gene, args.pdb, args.chain, nummodels ) ]
+  for job in jobs:
+    job.seed = args.seed
+    job.resume = args.resume
+    job.shard = shard
+    job.sampling = args.sampling
+    job.tissue = args.tissue if args.sampling == sampling.SAMPLING_TISSUE \
+                 else None
+    job.chain_only = args.chain_only
+    job.plan_only = bool( args.plan )
+
+  settings = None
+  try:
+    settings = LoadSettingsFromFile()
+  except IOError as e:
+    vm.Error( "Couldn't read settings file." )
+    vm.Error( "IOError: {}".format( e ) )
+    return 1
+
+  plan_file = None
+  plan_writer = None
+  if args.plan:
+    try:
+      plan_file = open( args.plan, "w" )
+    except IOError as e:
+      vm.Error( "Couldn't create plan file." )
+      vm.Error( "IOError: {}".format( e ) )
+      return 1
+    plan_writer = mapping.PlanWriter(
+      plan_file, args.plan.lower().endswith( ( ".jsonl", ".json" ) ) )
+
+  # Manifest jobs, or the models of a single job, are spread between the
+  # workers, which are started once the inputs are known.
+  planner = ExecutionPlanner( memory_budget, args.cpu_budget )
+  context = JobContext( settings, plan_writer, args.track_memory, planner,
+                        args.jobs )
+  error_code = 1
+  start_time = time.time()
+  try:
+    if args.manifest:
+      error_code = RunBatch( context, jobs )
+    else:
+      error_code = RunJob( context, jobs[0] )
+      jobs[0].status = "OK" if error_code == 0 else "FAILED"
+  finally:
+    context.StopPool()
+    # Close idle keep-alive connections of the shared pool.
+    GetConnectionPool().Clear()
+    if plan_file is not None:
+      plan_file.close()
+  for line in context.metrics.GetSummary():
+    vm.Print( line )
+  vm.Print( vm.HR_LINE )
+  if args.track_memory:
+    for line in context.metrics.GetMemoryReport():
+      vm.Print( line )
+    vm.Print( vm.HR_LINE )
+  if args.metrics:
+    try:
+      SaveMetrics( args.metrics, context.metrics, jobs,
+                   time.time() - start_time )
+    except IOError as e:
+      vm.Error( "Couldn't write metrics file." )
+      vm.Error( "IOError: {}".format( e ) )
+      return 1
+  if error_code == 0:
+    vm.Print( "All done." )
+  return error_code
+
+
 if __name__ == "__main__":
   vm.Banner( SCRIPT_NAME, SCRIPT_VERSION )
   SCRIPT_ERROR_CODE = 1
   try:
-    SCRIPT_ERROR_CODE = Main()
+    SCRIPT_ERROR_CODE = profiling.ProfileMain( Main )
   except RuntimeError as e:
     vm.Error( str( e ) )
   sys.exit( SCRIPT_ERROR_CODE )
@@ -23,6 +23,7 @@ import sys
 import time
 
 import m3r.messages as vm
+import m3r.profiling as profiling
 from pylint import lint
 
 SCRIPT_NAME = "M3R-PDB"
@@ -85,4 +86,4 @@ def RunLinter():
 
 if __name__ == "__main__":
   vm.Banner( "%s Tool PyLint Runner" % SCRIPT_NAME, SCRIPT_VERSION )
-  sys.exit( RunLinter() )
+  sys.exit( profiling.ProfileMain( RunLinter ) )